@@ -9,7 +9,7 @@ import utils
 import time
 import sys
 # import data
-from batcher import GenBatcher
+from batcher import GenBatcher, BatchSet
 from decode import Decoder
 from pointer_generator import PointerGenerator
 from rollout import Rollout
@@ -18,6 +18,7 @@ from utils import ensure_exists
 from gen_utils import calc_running_avg_loss
 from gen_utils import get_best_loss_from_chpt
 from gen_utils import save_ckpt as gen_save_ckpt
+from gen_utils import load_batcher_state
 from gan_utils import save_ckpt as gan_save_ckpt
 # from gan_utils import check_rouge
 # from dis_utils import eval_dis
@@ -81,6 +82,22 @@ tf.app.flags.DEFINE_string(
     Can include wildcards to access multiple datafiles.')
 tf.app.flags.DEFINE_string("enc_vocab_file", "enc_vocab", "the path of the generator vocabulary.")
 tf.app.flags.DEFINE_string("dec_vocab_file", "dec_vocab", "the path of the generator vocabulary.")
+tf.app.flags.DEFINE_integer('batcher_workers', 0, 'Number of processes building the training batches, each from its own subset of the data files. 0 to build them in threads of the trainer process.')
+tf.app.flags.DEFINE_integer('batcher_memory_mb', 0, 'If not 0, the approximate memory in MB of the examples and batches queued by the batcher, the producers wait while the queues are over it. 0 to only bound the number of the queued items.')
+tf.app.flags.DEFINE_integer('token_budget', 0, 'If not 0, the training batches have variable sizes and at most this many padded encoder and decoder tokens, batch size * (longest article + max_dec_steps). Only for pretrain_gen.')
+tf.app.flags.DEFINE_string('bucket_boundaries', '', 'Comma separated article lengths splitting the length buckets of the token budget batches, e.g. 20,40,60.')
+tf.app.flags.DEFINE_string('dedup_scope', 'window', 'Drop the duplicated training examples within the bucketing cache (window), the epoch across the reading streams (epoch) or the whole corpus including across the shards (global); with batcher_workers the epoch and global scopes only cover the files each worker process has read, or keep them (none).')
+tf.app.flags.DEFINE_boolean('use_shards', False, 'Read the token ids from the shards compiled by dataprocess/compile_shards.py instead of the text files.')
+tf.app.flags.DEFINE_boolean('use_length_index', False, 'Plan the bucketed training batches from the length indexes built by dataprocess/compile_length_index.py and read only their records.')
+tf.app.flags.DEFINE_boolean('input_pipeline', False, 'Take the training batches through a prefetching tf.data pipeline instead of feeding them at each step. Only for pretrain_gen.')
+tf.app.flags.DEFINE_integer('shuffle_buffer', 0, 'If not 0, the training records of every reading stream are shuffled in blocks of this many records, seeded by data_seed, before the bucketing. A resumed stream reads its current block again.')
+tf.app.flags.DEFINE_string('lcsts_source', '', 'If set, the raw LCSTS file, e.g. PART_I.txt, the training pairs are read and tokenized from on the fly instead of the train.txt_* files. The tokenized pairs are cached next to it per segmentation setting and size and modification time of the file.')
+tf.app.flags.DEFINE_boolean('lcsts_enc_segment', True, 'Segment the LCSTS articles into words, otherwise into chars.')
+tf.app.flags.DEFINE_boolean('lcsts_dec_segment', False, 'Segment the LCSTS abstracts into words, otherwise into chars.')
+tf.app.flags.DEFINE_integer('lcsts_chunks', 256, 'Number of the byte range chunks the LCSTS file is shared out and cached in, at least world_size times the reading streams.')
+tf.app.flags.DEFINE_integer('rank', 0, 'Index of this training process among the world_size ones sharing the training data.')
+tf.app.flags.DEFINE_integer('world_size', 1, 'Number of training processes, on this or other hosts, reading disjoint shares of the training data.')
+tf.app.flags.DEFINE_integer('data_seed', 111, 'Seed of the per epoch shuffling of the training files, it must be the same for all the ranks.')
 
 #  data_path/gen_vocab: vocabulary for the generator
 #  data_path/[decode/eval]_[positive/negative/source]: the data for the discriminator
@@ -151,6 +168,8 @@ FLAGS = tf.app.flags.FLAGS
 
 assert FLAGS.mode in ["pretrain_gen", "train_gan", "decode"]
 assert FLAGS.sample_rate >= 0 and FLAGS.sample_rate <= 0.5, "sample rate should be [0, 0.5]"
+assert FLAGS.token_budget == 0 or FLAGS.mode == "pretrain_gen", "the token budget batches are only for pretrain_gen"
+assert not FLAGS.input_pipeline or FLAGS.mode == "pretrain_gen", "the input pipeline is only for pretrain_gen"
 
 if FLAGS.mode == "train_gan":
     FLAGS.single_pass = False
@@ -181,10 +200,16 @@ def pretrain_generator(model, batcher, sess, batcher_val, model_saver, val_saver
     eval_save_steps = FLAGS.steps_per_checkpoint
     last_ten_eval_loss = deque(maxlen=10)
     counter = 0
+    if hps.input_pipeline:
+        model.start_input_pipeline(sess, batcher)
     while True:  # repeats until interrupted
-        batch = batcher.next_batch()
-        if batch is None:
-            return None
+        if hps.input_pipeline:
+            # the batches come from the input pipeline of the graph
+            batch = None
+        else:
+            batch = batcher.next_batch()
+            if batch is None:
+                return None
 
         results = model.run_one_batch(sess, batch)
         counter += 1
@@ -259,7 +284,8 @@ def pretrain_generator(model, batcher, sess, batcher_val, model_saver, val_saver
             # check if it is the best checkpoint so far
             eval_loss, best_loss = gen_save_ckpt(
                 sess, model, best_loss, model_dir, model_saver,
-                batcher_val, val_dir, val_saver, global_step, gan_eval=False)
+                batcher_val, val_dir, val_saver, global_step, gan_eval=False,
+                train_batcher=batcher)
             last_ten_eval_loss.append(eval_loss)
             if len(last_ten_eval_loss) == 15 and min(last_ten_eval_loss) == last_ten_eval_loss[0] and eval_save_steps > 5000:
                 last_ten_eval_loss = deque(maxlen=10)
@@ -273,7 +299,9 @@ def pretrain_generator(model, batcher, sess, batcher_val, model_saver, val_saver
             print_dashboard("Generator", global_step, hps.batch_size, hps.enc_vocab_size, hps.dec_vocab_size,
                             running_avg_loss, eval_loss,
                             total_training_time, current_speed, current_learing_rate,
-                            coverage_loss if coverage_loss else "not set")
+                            coverage_loss if coverage_loss else "not set",
+                            batcher.total_wait_time / counter, batcher.queue_stats(),
+                            prefetched=hps.input_pipeline)
 
 
 def main(argv):
@@ -313,6 +341,22 @@ def main(argv):
         'single_pass',
         'log_root',
         'data_path',
+        'use_shards',
+        'use_length_index',
+        'input_pipeline',
+        'batcher_workers',
+        'batcher_memory_mb',
+        'token_budget',
+        'bucket_boundaries',
+        'dedup_scope',
+        'shuffle_buffer',
+        'lcsts_source',
+        'lcsts_enc_segment',
+        'lcsts_dec_segment',
+        'lcsts_chunks',
+        'rank',
+        'world_size',
+        'data_seed',
     ]
 
     hps_dict = {}
@@ -475,15 +519,18 @@ def main(argv):
 
     # --------------- train models ---------------
     if FLAGS.mode != "decode":
-        gen_batcher_train = GenBatcher("train", "train", enc_vocab, dec_vocab, hps_gen)
-        gen_batcher_val = GenBatcher("val", "val", enc_vocab, dec_vocab, hps_gen)
+        # resume reading the data where the restored checkpoint stopped
+        batcher_state = load_batcher_state(ckpt_path) if FLAGS.mode == "pretrain_gen" else None
+        gen_batcher_train = GenBatcher("train", "train", enc_vocab, dec_vocab, hps_gen, state=batcher_state)
+        # the val batches are built once and reused by every evaluation
+        gen_batcher_val = BatchSet("val", enc_vocab, dec_vocab, hps_gen)
 
     if FLAGS.mode == "decode":
         decoder_batcher = GenBatcher("test", "test", enc_vocab, dec_vocab, hps_gen)
 
     if FLAGS.mode == "train_gan":
         # only for the gan bs rouge test
-        gan_batcher_test = GenBatcher("mini_v", "val", enc_vocab, dec_vocab, hps_gen)
+        gan_batcher_test = BatchSet("mini_v", enc_vocab, dec_vocab, hps_gen)
         # gan_batcher_val = GenBatcher("val", "val", enc_vocab, dec_vocab, hps_gen)
 
     if FLAGS.mode == "pretrain_gen":
@@ -521,7 +568,7 @@ def main(argv):
                 pre = []
                 rec = []
                 batch = gen_batcher_train.next_batch()
-                _, n_samples, _ = decoder.mc_generate(
+                n_samples, _ = decoder.mc_generate(
                     batch, s_num=hps_gan.sample_num)
                 assert np.array(n_samples).shape == (hps_gan.sample_num,
                                                      hps_gen.batch_size,
@@ -624,7 +671,7 @@ def main(argv):
                 batch = gen_batcher_train.next_batch()
 
                 # generate samples
-                enc_states, n_samples, n_targets_padding_mask = decoder.mc_generate(
+                n_samples, n_targets_padding_mask = decoder.mc_generate(
                     batch, s_num=hps_gan.sample_num)
                 assert np.array(n_samples).shape == (hps_gan.sample_num,
                                                      hps_gen.batch_size,
@@ -633,18 +680,9 @@ def main(argv):
                                                                   hps_gen.batch_size,
                                                                   hps_gen.max_dec_steps)
                 n_samples_no_start = np.array(n_samples)[:, :, 1:]
-                try:
-                    n_rewards = rollout.get_reward(
-                        hps_gan, sess, dec_vocab, batch, enc_states, n_samples,
-                        discriminator if FLAGS.dis_reward_ratio else None)
-                except:
-                    print('enc_states')
-                    print(enc_states)
-                    print('enc_states.shape')
-                    print(enc_states.shape)
-                    for st in enc_states:
-                        print(st.shape)
-                    raise
+                n_rewards = rollout.get_reward(
+                    hps_gan, sess, dec_vocab, batch, n_samples,
+                    discriminator if FLAGS.dis_reward_ratio else None)
 
                 # fine tune the generator
                 n_sample_targets = np.array(n_samples)[:, :, 1:]
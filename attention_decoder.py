@@ -25,6 +25,8 @@ import tensorflow as tf
 from utils import linear_mapping_weightnorm
 # from utils import global_selective_fn
 from utils import conv_decoder_stack
+from utils import conv_decoder_stack_step
+from utils import attention_key_projection
 
 
 # Note: this function is based on tf.contrib.legacy_seq2seq_attention_decoder,
@@ -77,3 +79,67 @@ def conv_attention_decoder(emb_dec_inputs, enc_padding_mask, attention_keys, att
         logits = tf.reshape(logits, [-1, vocab_size])
 
     return logits
+
+
+def conv_decoder_state_shapes(nhids_list=[256, 256, 256, 256], kwidths_list=[3, 3, 3, 3]):
+    """Returns the shapes, without the batch dimension, of the layer states
+    conv_attention_decoder_step takes"""
+    return [
+        [kwidth - 1, nhids_list[max(layer_idx - 1, 0)]]
+        for layer_idx, kwidth in enumerate(kwidths_list)]
+
+
+def conv_attention_key_projections(attention_keys, embed_size, cnn_layers=4):
+    """Projects the attention keys for the attention of every decoder layer,
+    once per encoder pass, for conv_attention_decoder_step.
+
+    Args:
+      attention_keys: the encoder outputs, shape (batch_size, enc_len, emb_dim)
+      embed_size: the decoder embedding size
+
+    Returns:
+      a list with the projected keys of every layer, shapes as attention_keys
+    """
+    projs = []
+    with tf.variable_scope("decoder_cnn"):
+        for layer_idx in range(cnn_layers):
+            with tf.variable_scope("attention_layer_" + str(layer_idx)):
+                projs.append(attention_key_projection(attention_keys, embed_size))
+    return projs
+
+
+def conv_attention_decoder_step(emb_dec_inputs, enc_padding_mask, attention_key_projs, attention_values,
+                                vocab_size, layer_states, nout_embed=256,
+                                nhids_list=[256, 256, 256, 256], kwidths_list=[3, 3, 3, 3],
+                                embedding_dropout_keep_prob=0.9, nhid_dropout_keep_prob=0.9, out_dropout_keep_prob=0.9):
+    """The incremental conv_attention_decoder at inference: it decodes only
+    the new position given the layer states of the positions before, so that
+    decoding a sequence is linear in its length.
+
+    Args:
+      emb_dec_inputs: the embedded latest tokens, shape (batch_size, 1, emb_dim)
+      attention_key_projs: the conv_attention_key_projections of the keys
+      layer_states: the layer states of the positions before, see
+        conv_decoder_state_shapes, zeros at the first position
+
+    Returns:
+      logits: shape (batch_size, vocab_size)
+      new_states: the layer states with the new position, to be gathered
+        with the hypotheses when they are reordered
+    """
+    with tf.variable_scope("decoder_cnn"):
+        next_layer = linear_mapping_weightnorm(
+            emb_dec_inputs, nhids_list[0], dropout=embedding_dropout_keep_prob,
+            var_scope_name="linear_mapping_before_cnn")
+
+        next_layer, new_states = conv_decoder_stack_step(
+            emb_dec_inputs, attention_key_projs, attention_values, next_layer, enc_padding_mask,
+            nhids_list, kwidths_list, {'src': embedding_dropout_keep_prob, 'hid': nhid_dropout_keep_prob}, layer_states)
+
+    with tf.variable_scope("softmax"):
+        outputs = linear_mapping_weightnorm(next_layer, nout_embed, var_scope_name="linear_mapping_after_cnn")
+
+    logits = linear_mapping_weightnorm(outputs, vocab_size, dropout=out_dropout_keep_prob, var_scope_name="logits_before_softmax")
+    logits = tf.reshape(logits, [-1, vocab_size])
+
+    return logits, new_states
@@ -20,17 +20,25 @@ from __future__ import absolute_import
 from __future__ import division
 
 import random
+import bisect
 import Queue
+import multiprocessing
 from random import shuffle
 from termcolor import colored
-from threading import Thread
+from threading import Thread, Condition, Lock
 import time
 import numpy as np
 import glob
 import data
+import lcsts
 import gzip
+import io
 import os
+import sys
+import traceback
 from collections import defaultdict as dd
+from collections import namedtuple, deque
+from functools import partial
 from cntk.tokenizer import text2charlist
 from codecs import open
 from utils import red_assert, red_print
@@ -43,12 +51,17 @@ def fopen(filename, mode='r'):
 
 
 class Example(object):
-    """Class representing a train/val/test example for text summarization."""
+    """Class representing a train/val/test example for text summarization.
+    The example queues hold many of them, so the ids are kept in int32
+    arrays, the decoder input and target are views of a single array and the
+    original strings are read from the corpus only when accessed."""
+
+    __slots__ = ("enc_input", "enc_len", "dec_len", "_dec_seq", "_abs_len", "_originals", "position", "source_ref")
 
     def __len__(self):
         return self.enc_len
 
-    def __init__(self, article, abstract, enc_vocab, dec_vocab, hps):
+    def __init__(self, article, abstract, enc_vocab, dec_vocab, hps, original_ref=None):
         """Initializes the Example, performing tokenization and truncation to
         produce the encoder, decoder and target sequences, which are stored in
         self.
@@ -57,98 +70,165 @@ class Example(object):
           article: source text; a string. each token is separated by a single
           space.
           hps: hyperparameters
+          original_ref: data.OriginalRef locating the strings in the corpus,
+            if given the strings are not kept
         """
-        self.hps = hps
-
-        # Get ids of special tokens
-        start_decoding = dec_vocab.word2id(data.START_DECODING)
-        stop_decoding = dec_vocab.word2id(data.STOP_DECODING)
-
         # Process the article
         article_words = article.split()
         if len(article_words) > hps.max_enc_steps:
             article_words = article_words[:hps.max_enc_steps]
-        # store the length after truncation but before padding
-        self.enc_len = len(article_words)
         # list of word ids; OOVs are represented by the id for UNK token
-        self.enc_input = [enc_vocab.word2id(w) for w in article_words]
+        enc_input = [enc_vocab.word2id(w) for w in article_words]
 
         # Process the abstract
         abstract_words = abstract.split()  # list of strings
         # list of word ids; OOVs are represented by the id for UNK token
         if len(abstract_words) > hps.max_dec_steps:
             abstract_words = abstract_words[:hps.max_dec_steps]
-        self.abs_ids = [dec_vocab.word2id(w) for w in abstract_words]
+        abs_ids = [dec_vocab.word2id(w) for w in abstract_words]
 
-        # Get the decoder input sequence and target sequence
-        self.dec_input, self.target = self.get_dec_inp_targ_seqs(
-            self.abs_ids, hps.max_dec_steps, start_decoding, stop_decoding)
-        self.dec_len = len(self.dec_input)
+        self.init_ids(enc_input, abs_ids, dec_vocab, hps)
 
         # Store the original strings ART:
-        self.original_article = article
-        self.original_abstract = abstract
+        self._originals = original_ref or (article, abstract)
         # print("article oovs: %s\n abstract_words: %s\n original article: %s\n original abstract: %s\n" %
         #       (' '.join(self.article_oovs), ' '.join(abstract_words), article, abstract))
         # self.original_abstract_sents = abstract_sentences
 
-    def get_dec_inp_targ_seqs(self, sequence, max_len, start_id, stop_id):
-        """Given the reference summary as a sequence of tokens, return the input
-        sequence for the decoder, and the target sequence which we will use to
-        calculate loss. The sequence will be truncated if it is longer than
-        max_len. The input sequence must start with the start_id and the target
-        sequence must end with the stop_id (but not if it's been truncated).
+    @classmethod
+    def from_ids(cls, enc_ids, abs_ids, dec_vocab, hps, original_ref):
+        """Builds the Example from the token ids of a compiled shard, no
+        tokenization or vocabulary lookup is done.
 
         Args:
-          sequence: List of ids (integers)
-          max_len: integer
-          start_id: integer
-          stop_id: integer
+          enc_ids: numpy array of the (untruncated) article ids
+          abs_ids: numpy array of the (untruncated) abstract ids
+          original_ref: data.OriginalRef to read the original strings lazily
+        """
+        example = cls.__new__(cls)
+        example.init_ids(enc_ids[:hps.max_enc_steps], abs_ids[:hps.max_dec_steps], dec_vocab, hps)
+        example._originals = original_ref
+        return example
 
-        Returns:
-          inp: sequence length <=max_len starting with start_id
-          target: sequence same length as input, ending with stop_id only if
-          there was no truncation
+    def init_ids(self, enc_input, abs_ids, dec_vocab, hps):
+        """Stores the truncated encoder ids and abstract ids and builds the
+        decoder input and target sequences.
+
+        The decoder input starts with the start id and the target ends with
+        the stop id, but not if the abstract was truncated; both have at most
+        max_dec_steps ids and are the windows [0, dec_len) and [1, dec_len]
+        of [start] + abstract + [stop].
         """
-        inp = [start_id] + sequence[:]
-        target = sequence[:]
-        if len(inp) > max_len:  # truncate
-            inp = inp[:max_len]
-            target = target[:max_len]  # no end_token
-        else:  # no truncation
-            target.append(stop_id)  # end token
-        red_assert(
-            len(inp) == len(target),
-            "abstracts and targets should be of same length but %s and %s" % (len(inp), len(target)))
-        return inp, target
+        # store the length after truncation but before padding
+        self.enc_len = len(enc_input)
+        self.enc_input = np.asarray(enc_input, dtype=np.int32)
+        self._abs_len = len(abs_ids)
+        self._dec_seq = np.empty(self._abs_len + 2, dtype=np.int32)
+        self._dec_seq[0] = dec_vocab.word2id(data.START_DECODING)
+        self._dec_seq[1:-1] = abs_ids
+        self._dec_seq[-1] = dec_vocab.word2id(data.STOP_DECODING)
+        self.dec_len = min(self._abs_len + 1, hps.max_dec_steps)
+        # the (stream, ReaderPosition) after the record of a training
+        # example and the OriginalRef of the record, set by the GenBatcher
+        self.position = None
+        self.source_ref = None
+
+    @property
+    def abs_ids(self):
+        return self._dec_seq[1:self._abs_len + 1]
+
+    @property
+    def dec_input(self):
+        return self._dec_seq[:self.dec_len]
+
+    @property
+    def target(self):
+        return self._dec_seq[1:self.dec_len + 1]
 
-    def pad_decoder_inp_targ(self, max_len, pad_id):
-        """Pad decoder input and target sequences with pad_id up to max_len."""
-        while len(self.dec_input) < max_len:
-            self.dec_input.append(pad_id)
-        while len(self.target) < max_len:
-            self.target.append(pad_id)
+    @property
+    def nbytes(self):
+        """Approximate memory of the Example in bytes"""
+        return (sys.getsizeof(self) + sys.getsizeof(self.enc_input) +
+                sys.getsizeof(self._dec_seq) + originals_nbytes(self._originals))
 
-    def pad_encoder_input(self, max_len, pad_id):
-        """Pad the encoder input sequence with pad_id up to max_len."""
-        while len(self.enc_input) < max_len:
-            self.enc_input.append(pad_id)
+    @property
+    def content_key(self):
+        """Hash of the (truncated) token ids, equal for duplicated examples"""
+        return hash((self.enc_input.tobytes(), self.abs_ids.tobytes()))
+
+    @property
+    def originals(self):
+        """The (article, abstract) strings, read from the corpus on the first
+        access if the Example keeps an OriginalRef"""
+        if isinstance(self._originals, data.OriginalRef):
+            self._originals = data.read_original(self._originals)
+        return self._originals
+
+    @property
+    def original_article(self):
+        return self.originals[0]
+
+    @property
+    def original_abstract(self):
+        return self.originals[1]
+
+
+def originals_nbytes(originals):
+    """Approximate memory in bytes of the (article, abstract) strings or of
+    the OriginalRef of an example"""
+    if isinstance(originals, data.OriginalRef):
+        return sys.getsizeof(originals)
+    return sys.getsizeof(originals) + sum(sys.getsizeof(s) for s in originals)
+
+
+def pad_ids(sequences, lens, max_len, pad_id, out=None):
+    """Pads the id sequences into an int32 array of shape (len(sequences),
+    max_len) with one masked assignment of the concatenated ids, without
+    modifying the sequences.
+
+    Args:
+      sequences: list of id arrays, sequences[i] has lens[i] ids
+      lens: numpy array of the lengths, none of them greater than max_len
+      out: optional int32 array of at least that shape, the ids are padded
+        into its leading part
+
+    Returns:
+      padded: the padded int32 array, a view of out if given
+      mask: bool array of the same shape, True for the real ids
+    """
+    mask = np.arange(max_len) < lens[:, np.newaxis]
+    if out is None:
+        padded = np.full((len(sequences), max_len), pad_id, dtype=np.int32)
+    else:
+        padded = out[:len(sequences), :max_len]
+        padded.fill(pad_id)
+    padded[mask] = np.concatenate(sequences)
+    return padded, mask
 
 
 class Batch(object):
     """Class representing a minibatch of train/val/test examples for text
     summarization."""
 
-    def __init__(self, example_list, hps, enc_vocab, dec_vocab):
+    def __init__(self, example_list, hps, enc_vocab, dec_vocab, slot=None, buffers=None):
         """Turns the example_list into a Batch object.
 
         Args:
            example_list: List of Example objects
            hps: hyperparameters
            vocab: Vocabulary object
+           slot: index of the BatchSlots slot the arrays are built in
+           buffers: the arrays of the slot by field name, see BatchSlots.views
         """
         self.pad_id = enc_vocab.word2id(
             data.PAD_TOKEN)  # id of the PAD token used to pad sequences
+        self.slot = slot
+        self._buffers = buffers
+        # only the discriminator and the decoding use these, they are built
+        # on the first access
+        self._max_enc_steps = hps.max_enc_steps
+        self._padded_enc_batch = None
+        self._padded_abs_ids = None
         # initialize the input to the encoder
         self.init_encoder_seq(example_list, hps)
         # initialize the input and targets for the decoder
@@ -156,6 +236,45 @@ class Batch(object):
         self.store_orig_strings(example_list)  # store the original strings
         self.batch_size = len(example_list)
         # the batch size may be not the same as the hp.batch_size
+        # the ReaderPositions after the last records of the batch by example
+        # stream, set by the GenBatcher
+        self.reader_positions = {}
+        # the duplicates the worker process dropped since its previous batch,
+        # set by the GenBatcher
+        self.num_duplicates = 0
+        self._buffers = None
+
+    def __getstate__(self):
+        """The arrays of a batch built in a slot are not pickled, the
+        consumer attaches the views of the shared slot instead."""
+        state = self.__dict__.copy()
+        if self.slot is not None:
+            for name in BatchSlots.FIELDS:
+                del state[name]
+            state["slot_width"] = self.enc_batch.shape[1]
+        return state
+
+    @property
+    def nbytes(self):
+        """Approximate memory of the Batch in bytes, not counting the arrays
+        in a shared memory slot"""
+        size = sys.getsizeof(self) + sum(originals_nbytes(orig) for orig in self._originals)
+        if self.slot is None:
+            size += sum(getattr(self, name).nbytes for name in BatchSlots.FIELDS)
+        return size
+
+    def _store(self, name, value, dtype):
+        """Returns value as a dtype array, copied into the slot buffer of the
+        field name if the batch is built in a slot"""
+        if self._buffers is None:
+            return value.astype(dtype, copy=False)
+        out = self._buffers[name][tuple(slice(n) for n in value.shape)]
+        out[...] = value
+        return out
+
+    def _pad_ids(self, name, sequences, lens, max_len, pad_id):
+        out = None if self._buffers is None else self._buffers[name]
+        return pad_ids(sequences, lens, max_len, pad_id, out)
 
     def init_encoder_seq(self, example_list, hps):
         """Initializes the following:
@@ -177,35 +296,41 @@ class Batch(object):
               Same as self.enc_batch, but in-article OOVs are represented by
               their temporary article OOV number.
         """
+        # the batch may have less examples than hps.batch_size when the
+        # batches are made under a token budget
+        self.enc_lens = self._store(
+            "enc_lens", np.array([ex.enc_len for ex in example_list]), np.int32)
         # Determine the maximum length of the encoder input sequence in this
         # batch
-        max_enc_seq_len = max([ex.enc_len for ex in example_list])
+        max_enc_seq_len = self.enc_lens.max()
         # the  length for each batch is different
 
         # Pad the encoder input sequences up to the length of the longest
         # sequence
-        for ex in example_list:
-            ex.pad_encoder_input(max_enc_seq_len, self.pad_id)
-
-        # Initialize the numpy arrays
         # Note: our enc_batch can have different length (second dimension) for
         # each batch because we use dynamic_rnn for the encoder.
-        self.enc_batch = np.zeros((hps.batch_size, max_enc_seq_len), dtype=np.int32)
-        self.padded_enc_batch = np.zeros((hps.batch_size, hps.max_enc_steps), dtype=np.int32)
-        self.padded_abs_ids = np.zeros((hps.batch_size, hps.max_dec_steps), dtype=np.int32)
-        self.enc_lens = np.zeros((hps.batch_size), dtype=np.int32)
-        self.enc_padding_mask = np.zeros((hps.batch_size, max_enc_seq_len), dtype=np.float32)
-
-        # Fill in the numpy arrays
-        for i, ex in enumerate(example_list):
-            i_enc_input = ex.enc_input[:]
-            i_abs_ids = ex.abs_ids[:]
-            self.enc_batch[i, :] = i_enc_input
-            self.padded_enc_batch[i, :len(i_enc_input)] = i_enc_input
-            self.padded_abs_ids[i, :len(i_abs_ids)] = i_abs_ids
-            self.enc_lens[i] = ex.enc_len
-            for j in range(ex.enc_len):
-                self.enc_padding_mask[i][j] = 1
+        enc_inputs = [ex.enc_input for ex in example_list]
+        self.enc_batch, enc_mask = self._pad_ids(
+            "enc_batch", enc_inputs, self.enc_lens, max_enc_seq_len, self.pad_id)
+        self.enc_padding_mask = self._store("enc_padding_mask", enc_mask, np.float32)
+
+    @property
+    def padded_enc_batch(self):
+        """enc_batch padded with 0 up to max_enc_steps"""
+        if self._padded_enc_batch is None:
+            padded = np.zeros((len(self.enc_lens), self._max_enc_steps), dtype=np.int32)
+            padded[:, :self.enc_batch.shape[1]] = np.where(self.enc_padding_mask > 0, self.enc_batch, 0)
+            self._padded_enc_batch = padded
+        return self._padded_enc_batch
+
+    @property
+    def padded_abs_ids(self):
+        """The abstract ids padded with 0 up to max_dec_steps, the targets
+        without the stop id"""
+        if self._padded_abs_ids is None:
+            mask = np.arange(self.target_batch.shape[1]) < self.abs_lens[:, np.newaxis]
+            self._padded_abs_ids = np.where(mask, self.target_batch, 0).astype(np.int32)
+        return self._padded_abs_ids
 
     def init_decoder_seq(self, example_list, hps):
         """Initializes the following:
@@ -221,33 +346,245 @@ class Batch(object):
               numpy array of shape (batch_size, max_dec_steps), containing 1s
               and 0s. 1s correspond to real tokens in dec_batch and
               target_batch; 0s correspond to padding.
+            self.abs_lens:
+              numpy array of shape (batch_size) containing the (truncated)
+              length of each abstract.
             """
-        # Pad the inputs and targets
-        for ex in example_list:
-            ex.pad_decoder_inp_targ(hps.max_dec_steps, self.pad_id)
+        dec_lens = np.array([ex.dec_len for ex in example_list], dtype=np.int32)
+        # the targets start with the abstract ids
+        self.abs_lens = self._store(
+            "abs_lens", np.array([len(ex.abs_ids) for ex in example_list]), np.int32)
 
-        # Initialize the numpy arrays.
+        # Pad the inputs and targets
         # Note: our decoder inputs and targets must be the same length for each
         # batch (second dimension = max_dec_steps) because we do not use a
         # dynamic_rnn for decoding. However I believe this is possible, or will
         # soon be possible, with Tensorflow 1.0, in which case it may be best to
         # upgrade to that.
-        self.dec_batch = np.zeros((hps.batch_size, hps.max_dec_steps), dtype=np.int32)
-        self.target_batch = np.zeros((hps.batch_size, hps.max_dec_steps), dtype=np.int32)
-        self.dec_padding_mask = np.zeros((hps.batch_size, hps.max_dec_steps), dtype=np.float32)
-        # Fill in the numpy arrays
-        for i, ex in enumerate(example_list):
-            self.dec_batch[i, :] = ex.dec_input[:]
-            self.target_batch[i, :] = ex.target[:]
-            for j in range(ex.dec_len):
-                self.dec_padding_mask[i][j] = 1
+        self.dec_batch, dec_mask = self._pad_ids(
+            "dec_batch", [ex.dec_input for ex in example_list], dec_lens, hps.max_dec_steps, self.pad_id)
+        self.target_batch, _ = self._pad_ids(
+            "target_batch", [ex.target for ex in example_list], dec_lens, hps.max_dec_steps, self.pad_id)
+        self.dec_padding_mask = self._store("dec_padding_mask", dec_mask, np.float32)
 
     def store_orig_strings(self, example_list):
         """Store the original article and abstract strings in the Batch
-        object"""
-        self.original_articles = [ex.original_article for ex in example_list]  # list of lists
-        self.original_abstracts = [ex.original_abstract for ex in example_list]  # list of lists
-        # list of list of lists
+        object. Those of the compiled shards are kept as data.OriginalRef and
+        only read when original_articles or original_abstracts is accessed"""
+        self._originals = [ex._originals for ex in example_list]
+
+    def _resolve_originals(self):
+        refs = [orig for orig in self._originals if isinstance(orig, data.OriginalRef)]
+        if refs:
+            strings = data.read_originals(refs)
+            self._originals = [
+                strings[orig] if isinstance(orig, data.OriginalRef) else orig
+                for orig in self._originals]
+
+    @property
+    def original_articles(self):
+        self._resolve_originals()
+        return [orig[0] for orig in self._originals]  # list of strings
+
+    @property
+    def original_abstracts(self):
+        self._resolve_originals()
+        return [orig[1] for orig in self._originals]  # list of strings
+
+
+class BatchSlots(object):
+    """A ring of batch slots in shared memory, allocated before the worker
+    processes are forked. A worker builds the arrays of a Batch straight into
+    a free slot and only the rest of the Batch is pickled through the batch
+    queue; the consumer attaches views of the slot to it, without copy, and
+    releases the slot at the next next_batch."""
+
+    # name: (dtype, width), the arrays of a batch are the leading rows of
+    # the slot arrays, and the leading columns for the width "enc" of the
+    # longest article of the batch
+    FIELDS = {
+        "enc_lens": (np.int32, None),
+        "enc_batch": (np.int32, "enc"),
+        "enc_padding_mask": (np.float32, "enc"),
+        "abs_lens": (np.int32, None),
+        "dec_batch": (np.int32, "max_dec"),
+        "target_batch": (np.int32, "max_dec"),
+        "dec_padding_mask": (np.float32, "max_dec"),
+    }
+    # the owner of a slot is the worker building it, or one of these
+    FREE = -1
+    POSTED = -2
+
+    def __init__(self, num_slots, rows, max_enc_steps, max_dec_steps):
+        """
+        Args:
+          num_slots: number of slots
+          rows: the largest batch size
+        """
+        widths = {"enc": max_enc_steps, "max_dec": max_dec_steps}
+        self._arrays = {}
+        for name, (dtype, width) in self.FIELDS.items():
+            shape = (num_slots, rows) if width is None else (num_slots, rows, widths[width])
+            self._arrays[name] = self._shared_array(shape, dtype)
+        self._owners = self._shared_array((num_slots,), np.int32)
+        self._owners.fill(self.FREE)
+        self.num_slots = num_slots
+        self.slot_nbytes = self.slot_size(rows, max_enc_steps, max_dec_steps)
+        # not a queue of the free slots: a worker killed while blocked in its
+        # get would keep the lock of the queue
+        self._num_free = multiprocessing.Semaphore(num_slots)
+        self._lock = multiprocessing.Lock()
+
+    @staticmethod
+    def _shared_array(shape, dtype):
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        raw = multiprocessing.RawArray(str("c"), size)
+        return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+    def acquire(self, owner):
+        """Blocks until a slot is free and returns its index and the views of
+        its arrays by field name, to build a Batch in.
+
+        Args:
+          owner: the id of the worker process taking the slot
+        """
+        self._num_free.acquire()
+        with self._lock:
+            slot = int(np.flatnonzero(self._owners == self.FREE)[0])
+            self._owners[slot] = owner
+        return slot, dict((name, array[slot]) for name, array in self._arrays.items())
+
+    @staticmethod
+    def slot_size(rows, max_enc_steps, max_dec_steps):
+        """Bytes of the arrays of a slot"""
+        widths = {None: 1, "enc": max_enc_steps, "max_dec": max_dec_steps}
+        return sum(rows * widths[width] * np.dtype(dtype).itemsize
+                   for dtype, width in BatchSlots.FIELDS.values())
+
+    def num_used(self):
+        """Number of the slots taken by the workers or the consumer"""
+        return int((self._owners != self.FREE).sum())
+
+    def post(self, slot):
+        """Marks the slot as handed to the consumer, just before its Batch is
+        put into the batch queue"""
+        self._owners[slot] = self.POSTED
+
+    def attach(self, batch):
+        """Sets the arrays of a Batch unpickled from the batch queue to the
+        views of its slot"""
+        rows, width = batch.batch_size, batch.__dict__.pop("slot_width")
+        for name, (_, field_width) in self.FIELDS.items():
+            array = self._arrays[name][batch.slot, :rows]
+            setattr(batch, name, array[:, :width] if field_width == "enc" else array)
+
+    def release(self, slot):
+        with self._lock:
+            self._owners[slot] = self.FREE
+        self._num_free.release()
+
+    def reclaim(self, owner):
+        """Releases the slots taken by a dead worker before it posted them"""
+        for slot in np.flatnonzero(self._owners == owner):
+            self.release(int(slot))
+
+
+class BudgetedQueue(object):
+    """A queue of the Examples or the Batches of a process bounded both by the
+    number of items and by their approximate bytes, see the nbytes of Example
+    and Batch. put blocks while the queue is at either limit, except that an
+    empty queue takes any item so that a large one can not block forever.
+    The other items, None or ProducerFailure, count no bytes."""
+
+    def __init__(self, maxsize, max_bytes=0):
+        """
+        Args:
+          maxsize: the maximum number of items
+          max_bytes: the budget of the items in bytes, 0 for no budget
+        """
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._items = deque()
+        self._nbytes = 0
+        self._mutex = Lock()
+        self._not_empty = Condition(self._mutex)
+        self._not_full = Condition(self._mutex)
+
+    @staticmethod
+    def item_nbytes(item):
+        if isinstance(item, list):  # the Examples of a planned batch
+            return sum(ex.nbytes for ex in item)
+        return getattr(item, "nbytes", 0)
+
+    def _full(self, nbytes):
+        return len(self._items) > 0 and (
+            len(self._items) >= self.maxsize or
+            (self.max_bytes and self._nbytes + nbytes > self.max_bytes))
+
+    def put(self, item):
+        nbytes = self.item_nbytes(item)
+        with self._not_full:
+            while self._full(nbytes):
+                self._not_full.wait()
+            self._items.append((item, nbytes))
+            self._nbytes += nbytes
+            self._not_empty.notify()
+
+    def get(self, timeout=None):
+        """Removes and returns the first item, raises Queue.Empty if there is
+        none after timeout seconds"""
+        with self._not_empty:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self._items:
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Queue.Empty
+                    self._not_empty.wait(remaining)
+                else:
+                    self._not_empty.wait()
+            item, nbytes = self._items.popleft()
+            self._nbytes -= nbytes
+            # the freed bytes may let more than one producer in
+            self._not_full.notify_all()
+            return item
+
+    def qsize(self):
+        return len(self._items)
+
+    @property
+    def nbytes(self):
+        """Approximate bytes of the queued items"""
+        return self._nbytes
+
+    def stats(self):
+        """The number of items, their bytes and the fill level, the larger of
+        the fractions of the two limits"""
+        fill = len(self._items) / self.maxsize
+        if self.max_bytes:
+            fill = max(fill, self._nbytes / self.max_bytes)
+        return {"items": len(self._items), "bytes": self._nbytes, "fill": fill}
+
+
+# Reading position of an example stream: the files of an epoch are shuffled by
+# random.Random(seed + epoch), and the stream resumes at the first record of
+# its file_index-th split (see GenBatcher.get_splits) whose byte offset is not
+# less than offset. With a shuffle buffer the position is the start of a
+# block and the stream resumes after its first emitted records, see
+# GenBatcher.shuffled_generator
+ReaderPosition = namedtuple("ReaderPosition", ["seed", "epoch", "file_index", "offset", "emitted"])
+
+
+class ProducerFailure(object):
+    """Put into the batch queue by a producer thread or worker process that
+    raised, so that the consumer learns about the crash at its next get
+    instead of waiting for data that never comes."""
+
+    def __init__(self, kind, index, trace, pid=None):
+        self.kind = kind  # "example", "batch" or "worker"
+        self.index = index
+        self.trace = trace
+        self.pid = pid
 
 
 class GenBatcher(object):
@@ -256,8 +593,15 @@ class GenBatcher(object):
     # TODO: bucket can be added
 
     BATCH_QUEUE_MAX = 100  # max number of batches the batch_queue can hold
+    # a killed worker process can not report its failure, so the workers are
+    # checked at every next_batch and at this interval while it is starving
+    WORKER_CHECK_SECS = 10
+    # the least number of shared memory batch slots of the worker processes
+    BATCH_SLOTS = 16
+    # hps.batcher_memory_mb is shared out evenly between the batch queue, or
+    # the slots of the worker processes, and the example queues
 
-    def __init__(self, file_name, mode, enc_vocab, dec_vocab, hps):
+    def __init__(self, file_name, mode, enc_vocab, dec_vocab, hps, state=None):
         """Initialize the batcher. Start threads that process the data into
         batches.
 
@@ -273,6 +617,8 @@ class GenBatcher(object):
                   single thread and generate None and close files when it ends
           vocab: Vocabulary object
           hps: hyperparameters from the generator
+          state: the state returned by state() of a previous run, the example
+            streams resume from the saved positions
         """
         self._enc_vocab = enc_vocab
         self._dec_vocab = dec_vocab
@@ -283,14 +629,47 @@ class GenBatcher(object):
         self._mode = mode
         self._data_path = os.path.join(hps.data_path, file_name) + ".txt_*"
         self._minutes = 0
+        # in train mode the duplicated examples are dropped within the scope
+        # of the bucketing cache ("window"), of the epoch of the streams of
+        # the process ("epoch") or of the whole corpus ("global"), or kept
+        # ("none")
+        red_assert(
+            hps.dedup_scope in ["window", "epoch", "global", "none"],
+            "dedup_scope should be in ['window', 'epoch', 'global', 'none'] but %s provided" % hps.dedup_scope)
+        self._dedup_scope = hps.dedup_scope
+        # maps the content hash to the location of its first occurrence, in
+        # the "global" scope and by epoch in the "epoch" scope
+        self._dedup_index = {}
+        self._epoch_dedup_indexes = {}
+        self._dedup_lock = Lock()
+        self._num_duplicates = 0
+        # the duplicates of a worker process reported with its batches
+        self._reported_duplicates = 0
         self._files_name_dict = dd(lambda: 0)
         # self._log_writer = open("./gen_batcher_writer", "a", "utf-8")
 
+        # in train mode the batches can be planned from the length indexes of
+        # the shards, then the example queue holds lists of Examples
+        self._use_length_index = mode == "train" and hps.use_length_index
+        # in train mode the pairs can be read and tokenized straight from the
+        # raw LCSTS corpus instead of the text files
+        self._lcsts = None
+        if mode == "train" and hps.lcsts_source:
+            red_assert(
+                not (hps.use_shards or hps.use_length_index),
+                "the LCSTS source is tokenized on the fly, there are no shards or length indexes")
+            self._lcsts = lcsts.LcstsSource(
+                hps.lcsts_source, hps.lcsts_enc_segment, hps.lcsts_dec_segment, hps.lcsts_chunks)
+
+        # the memory budget of the queued Batches and of the queued Examples
+        # of all the processes, in bytes, 0 if the queues are only bounded
+        # by their number of items
+        self._queue_budget = int(hps.batcher_memory_mb * 2 ** 20) // 2
+
         # Initialize a queue of Batches waiting to be used, and a queue of
         # Examples waiting to be batched
-        self._batch_queue = Queue.Queue(self.BATCH_QUEUE_MAX)
-        self._example_queue = Queue.Queue(
-            self.BATCH_QUEUE_MAX * self._hps.batch_size * self._hps.beam_size)
+        self._batch_queue = BudgetedQueue(self.BATCH_QUEUE_MAX, self._queue_budget)
+        self._example_queue = BudgetedQueue(self.example_queue_size(), self._queue_budget)
 
         # Different settings depending on whether we're in single_pass mode or
         # not
@@ -301,8 +680,6 @@ class GenBatcher(object):
             # only load one batch's worth of examples before bucketing; this
             # essentially means no bucketing
             self._bucketing_cache_size = 1
-            # this will tell us when we're finished reading the dataset
-            self._finished_reading = False
         else:
             self._num_example_q_threads = 16
             # self._num_example_q_threads = 1
@@ -313,86 +690,425 @@ class GenBatcher(object):
             # bucketing
             self._bucketing_cache_size = 100
             # self._bucketing_cache_size = 1
+            # the encoder lengths splitting the buckets of the batches built
+            # under hps.token_budget
+            self._bucket_boundaries = sorted(
+                int(b) for b in hps.bucket_boundaries.split(",") if b.strip())
+            # num processes to build batches from disjoint subsets of the
+            # files, 0 to build them in the threads of this process
+            self._num_workers = hps.batcher_workers
+            # the data is shared out between the example streams of all the
+            # ranks, hps.world_size training processes
+            self._num_streams = self._num_workers or self._num_example_q_threads
+            red_assert(
+                0 <= hps.rank < hps.world_size,
+                "rank should be in [0, %s) but %s provided" % (hps.world_size, hps.rank))
 
-            # Start a thread that watches the other threads and restarts them if
-            # they're dead
-            self._watch_thread = Thread(target=self.watch_threads)
-            self._watch_thread.daemon = True
-            self._watch_thread.start()
-            # We don't want a watcher in single_pass mode because the threads
-            # shouldn't run forever
-
-        # Start the threads that load the queues
+        # the id of the worker process reading a subset of the files, None in
+        # the main process
+        self._worker_id = None
         self._example_q_threads = []
-        for _ in range(self._num_example_q_threads):
-            self._example_q_threads.append(
-                Thread(target=self.fill_example_queue))
-            self._example_q_threads[-1].daemon = True
-            self._example_q_threads[-1].start()
         self._batch_q_threads = []
-        for _ in range(self._num_batch_q_threads):
-            self._batch_q_threads.append(Thread(target=self.fill_batch_queue))
-            self._batch_q_threads[-1].daemon = True
-            self._batch_q_threads[-1].start()
+        self._workers = []
+        # the shared memory the worker processes build the batches in, and
+        # the slot of the batch last returned by next_batch
+        self._slots = None
+        self._held_slot = None
+        # set when the None batch ending the test data has been returned
+        self._exhausted = False
+        # the live ReaderPositions of the streams read in this process, the
+        # positions of the records read by the generators, ahead of the live
+        # ones with a shuffle buffer, and the positions of the streams as of
+        # the batches returned by next_batch, all keyed by the stream name
+        self._positions = {}
+        self._read_positions = {}
+        self._consumed_positions = {}
+        self._restored_positions = {}
+        if state:
+            for stream, pos in state["positions"].items():
+                self._restored_positions[stream] = ReaderPosition(
+                    pos["seed"], pos["epoch"], pos["file_index"], pos["offset"],
+                    pos.get("emitted", 0))
+        self._initial_positions = dict(self._restored_positions)
+        # seconds the consumer was blocked in next_batch
+        self._last_wait_time = 0.
+        self._total_wait_time = 0.
+        if mode == "train" and self._num_workers:
+            self.start_workers()
+        else:
+            # Start the threads that load the queues
+            for idx in range(self._num_example_q_threads):
+                self._example_q_threads.append(self._start_thread("example", idx))
+            for idx in range(self._num_batch_q_threads):
+                self._batch_q_threads.append(self._start_thread("batch", idx))
+
+    def example_queue_size(self):
+        if self._use_length_index:
+            return self.BATCH_QUEUE_MAX
+        return self.BATCH_QUEUE_MAX * self._hps.batch_size * self._hps.beam_size
+
+    def _start_thread(self, kind, index):
+        if kind == "example":
+            # the reader index of a worker process is its worker id
+            target = partial(
+                self.fill_example_queue, index if self._worker_id is None else self._worker_id)
+        else:
+            target = self.fill_batch_queue
+        t = Thread(target=self.run_producer, args=(target, kind, index))
+        t.daemon = True
+        t.start()
+        return t
+
+    def run_producer(self, target, kind, index):
+        """Runs the loop of a producer and reports its crash to the consumer
+        through the batch queue. A worker process exits on the crash of any
+        of its loops and is restarted as a whole."""
+        try:
+            target()
+        except Exception:
+            trace = traceback.format_exc()
+            if self._worker_id is None:
+                self._batch_queue.put(ProducerFailure(kind, index, trace))
+            else:
+                self._batch_queue.put(
+                    ProducerFailure("worker", self._worker_id, trace, os.getpid()))
+                # flush the queue before leaving without the cleanup of the
+                # threads that are still blocked
+                self._batch_queue.close()
+                self._batch_queue.join_thread()
+                os._exit(1)
+
+    def start_workers(self):
+        """Start the worker processes. Each of them owns a subset of the data
+        files and puts fully built Batches into a process safe batch queue,
+        so that the tokenization is not serialized by the GIL. The restored
+        positions are taken by the forked workers, a restarted worker gets
+        the position of its stream as of the consumed batches instead."""
+        red_assert(self._lcsts or glob.glob(self._data_path), 'Error: Empty filelist at %s' % self._data_path)
+        self._batch_queue = multiprocessing.Queue(self.BATCH_QUEUE_MAX)
+        hps = self._hps
+        rows = hps.batch_size
+        if hps.token_budget:
+            # every example has at least one encoder token
+            rows = max(rows, hps.token_budget // (1 + hps.max_dec_steps))
+        num_slots = max(self.BATCH_SLOTS, 2 * self._num_workers)
+        if self._queue_budget:
+            # a worker and the consumer need a slot each to make progress
+            num_slots = max(
+                self._num_workers + 2,
+                self._queue_budget // BatchSlots.slot_size(rows, hps.max_enc_steps, hps.max_dec_steps))
+        self._slots = BatchSlots(num_slots, rows, hps.max_enc_steps, hps.max_dec_steps)
+        for worker_id in range(self._num_workers):
+            self._workers.append(self._start_worker(worker_id))
+        self._restored_positions.clear()
+
+    def _start_worker(self, worker_id):
+        worker = multiprocessing.Process(target=self.run_worker, args=(worker_id,))
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def run_worker(self, worker_id):
+        """The loop of a worker process: one thread reads and tokenizes the
+        owned files, and the batches are bucketed and built in this one."""
+        self._worker_id = worker_id
+        # the forked count of the consumer includes those of the workers
+        self._num_duplicates = 0
+        self._reported_duplicates = 0
+        # the forked workers should not share the shuffling order
+        random.seed()
+        np.random.seed()
+        self._example_queue = BudgetedQueue(
+            self.example_queue_size(), self._queue_budget // self._num_workers)
+        self._start_thread("example", 0)
+        self.run_producer(self.fill_batch_queue, "batch", 0)
 
     def next_batch(self):
-        """Return a Batch from the batch queue.
+        """Return a Batch from the batch queue, blocking until a batch, the end
+        of the data or the failure of a producer arrives. In train mode the
+        failed producer is restarted, otherwise the failure is raised.
 
         If mode='decode' then each batch contains a single example repeated
         beam_size-many times; this is necessary for beam search.
 
+        The arrays of a batch built by a worker process are views of a shared
+        memory slot that is reused after the next call, they have to be copied
+        to be kept longer.
+
         Returns:
           batch: a Batch object, or None if we're in single_pass mode and we've
           exhausted the dataset.
         """
-        # If the batch queue is empty, print a warning
-        if self._batch_queue.qsize() == 0:
-            print('Bucket input queue is empty when calling next_batch. Bucket queue size: %i, Input queue size: %i' % (
-                        self._batch_queue.qsize(),
-                        self._example_queue.qsize()))
-            # red_assert(self._mode == "test" and self._finished_reading, "queue is empty, the mode should be 'test' but %s found" % self._mode)
-            if self._mode == "test" and self._finished_reading:
-                return None
+        if self._exhausted:
+            return None
+        if self._held_slot is not None:
+            # the step of the previous batch is over
+            self._slots.release(self._held_slot)
+            self._held_slot = None
+        start = time.time()
+        batch = self._get_batch()
+        while isinstance(batch, ProducerFailure):
+            self.handle_failure(batch)
+            batch = self._get_batch()
+        self._last_wait_time = time.time() - start
+        self._total_wait_time += self._last_wait_time
+        if batch is not None:
+            if batch.slot is not None:
+                self._slots.attach(batch)
+                self._held_slot = batch.slot
+                self._num_duplicates += batch.num_duplicates
+            for stream, pos in batch.reader_positions.items():
+                consumed = self._consumed_positions.get(stream)
+                # the batches of the batch threads are not returned in order
+                if consumed is None or pos[1:] > consumed[1:]:
+                    self._consumed_positions[stream] = pos
+        if batch is None and self._mode == "test":
+            self._exhausted = True
+        return batch
+
+    def _get_batch(self):
+        if not self._workers:
+            return self._batch_queue.get()
+        while True:
+            for idx, p in enumerate(self._workers):
+                if not p.is_alive():  # maybe killed without reporting
+                    return ProducerFailure(
+                        "worker", idx, "exit code %s" % p.exitcode, p.pid)
+            try:
+                return self._batch_queue.get(timeout=self.WORKER_CHECK_SECS)
+            except Queue.Empty:
+                pass
+
+    def handle_failure(self, failure):
+        """Restarts the failed producer in train mode. The val and test data
+        are read once in order, they can not be resumed so the failure is
+        raised."""
+        red_print("Found %s producer %s dead:\n%s" % (failure.kind, failure.index, failure.trace))
+        if self._mode != "train":
+            raise Exception(
+                "the %s producer of the %s batcher failed" % (failure.kind, self._mode))
+        if failure.kind == "worker":
+            # both the report and the liveness check may find the same death
+            if self._workers[failure.index].pid == failure.pid:
+                print('Restarting worker process %s.' % failure.index)
+                self._slots.reclaim(failure.index)
+                # the batches of the dead worker still in its slots are lost,
+                # the new one resumes after the records consumed so far
+                stream = "worker-%s" % failure.index
+                pos = self._consumed_positions.get(stream) or self._initial_positions.get(stream)
+                if pos is not None:
+                    self._restored_positions[stream] = pos
+                self._workers[failure.index] = self._start_worker(failure.index)
+                self._restored_positions.pop(stream, None)
+        elif failure.kind == "example":
+            print('Restarting example queue thread.')
+            self._example_q_threads[failure.index] = self._start_thread("example", failure.index)
+        else:
+            print('Restarting batch queue thread.')
+            self._batch_q_threads[failure.index] = self._start_thread("batch", failure.index)
+
+    def stream_name(self, reader):
+        """Name of the example stream of the reader index in this rank"""
+        if self._worker_id is not None:
+            return "worker-%s" % reader
+        return "thread-%s" % reader
+
+    def state(self):
+        """Returns the reading positions of the example streams as of the
+        batches returned so far, a json serializable dict to be passed to the
+        constructor of the resumed batcher. Every stream resumes after the
+        furthest of its records returned in a batch, so the examples read
+        ahead into the queues are read again after resuming, except those
+        the bucketing cache left behind that record."""
+        positions = dict(self._initial_positions)
+        positions.update(self._consumed_positions)
+        return {"positions": dict(
+            (stream, pos._asdict()) for stream, pos in positions.items())}
+
+    def start_position(self, stream):
+        """The position the stream starts from: the restored one, which is the
+        consumed one for a restarted worker process, the last one if a thread
+        of the stream is restarted after a failure, or the beginning of the
+        first epoch. The streams of all the ranks share hps.data_seed so they
+        agree on the file order."""
+        pos = self._restored_positions.pop(stream, None) or self._positions.get(stream)
+        if pos is None:
+            pos = ReaderPosition(self._hps.data_seed, 0, 0, 0, 0)
+        self._positions[stream] = pos
+        self._read_positions[stream] = pos
+        return pos
+
+    def queue_stats(self):
+        """The number of items, the approximate bytes and the fill level of
+        the queues of this process, see BudgetedQueue.stats. With worker
+        processes the batches are reported by the shared memory slots in use
+        and the example queues of the workers are not visible."""
+        stats = {}
+        if self._slots is None:
+            stats["batch_queue"] = self._batch_queue.stats()
+            stats["example_queue"] = self._example_queue.stats()
+        else:
+            used = self._slots.num_used()
+            stats["batch_slots"] = {
+                "items": used, "bytes": used * self._slots.slot_nbytes,
+                "fill": used / self._slots.num_slots}
+        return stats
+
+    def shuffled_generator(self, reader, records):
+        """Shuffles the records of the stream in blocks of hps.shuffle_buffer
+        records: a block is read into the buffer, shuffled by a generator
+        seeded by hps.data_seed, the stream and the position the block starts
+        at, and emitted before the next block is read. A block also ends with
+        the epoch. The live position of the stream is the start of its block
+        and the number of the records of the block emitted so far, so a
+        resumed stream reads at most one block again to refill the buffer as
+        it was.
+
+        Args:
+          reader: index of the example stream in this rank
+          records: iterator of the records of the stream, whose generator
+            keeps their positions in self._read_positions
+        """
+        stream = self.stream_name(reader)
+        pos = self._restored_positions.get(stream) or self._positions.get(stream)
+        if pos is None:
+            pos = ReaderPosition(self._hps.data_seed, 0, 0, 0, 0)
+        skip = pos.emitted
+        block_start = pos._replace(emitted=0)
+        # the first record of the next epoch, read while filling the buffer
+        pending = None
+        while True:
+            block = [] if pending is None else [pending]
+            pending = None
+            exhausted = False
+            while len(block) < self._hps.shuffle_buffer:
+                record = next(records, None)
+                if record is None:
+                    exhausted = True
+                    break
+                read_pos = self._read_positions[stream]
+                if read_pos.epoch != block_start.epoch:
+                    pending = record
+                    break
+                block.append(record)
+            rng = random.Random("%s:%s:%s:%s" % (
+                self._hps.data_seed, self._hps.rank, stream, tuple(block_start[1:4])))
+            rng.shuffle(block)
+            for emitted, record in enumerate(block, 1):
+                if emitted <= skip:
+                    # emitted before the stream was resumed
+                    continue
+                self._positions[stream] = block_start._replace(emitted=emitted)
+                yield record
+            skip = 0
+            if exhausted:
+                return
+            if pending is None:
+                block_start = self._read_positions[stream]._replace(emitted=0)
             else:
-                red_print("batch queue empty, waiting 2 seconds")
-                time.sleep(2)
+                block_start = ReaderPosition(block_start.seed, read_pos.epoch, 0, 0, 0)
 
-        batch = self._batch_queue.get()  # get the next Batch
-        return batch
+    @property
+    def last_wait_time(self):
+        """Seconds the last next_batch call waited for data"""
+        return self._last_wait_time
+
+    @property
+    def total_wait_time(self):
+        """Seconds all the next_batch calls waited for data"""
+        return self._total_wait_time
 
-    def fill_example_queue(self):
+    def fill_example_queue(self, reader):
         """Reads data from file and processes into Examples which are then
-        placed into the example queue."""
+        placed into the example queue.
 
-        input_gen = self.text_generator()
+        Args:
+          reader: index of the example stream in this rank
+        """
+
+        if self._use_length_index:
+            input_gen = self.planned_generator(reader)
+        elif self._hps.use_shards:
+            input_gen = self.shard_generator(reader)
+        elif self._lcsts:
+            input_gen = self.lcsts_generator(reader)
+        else:
+            input_gen = self.text_generator(reader)
+        # the order within the files is shuffled as well
+        shuffled = self._mode == "train" and self._hps.shuffle_buffer and not self._use_length_index
+        if shuffled:
+            input_gen = self.shuffled_generator(reader, input_gen)
+        # the dedup index of the epoch of the stream in the "epoch" scope
+        dedup_index = None
+        dedup_epoch = None
+        stream = self.stream_name(reader)
+        # the content hashes in the "window" scope of the planned batches,
+        # mapped to the location of their first occurrence
+        window_index = {}
 
         while True:
             try:
                 # read the next example from file. article and abstract are both
-                # strings.
-                (article, abstract) = input_gen.next()
+                # strings, or ids and the OriginalRef if reading the shards.
+                record = input_gen.next()
             except StopIteration:  # if there are no more examples:
                 red_print(
                     "The example generator for this example queue filling thread has exhausted data.")
                 if self._mode in ['test']:
                     red_print(
                         "single_pass mode is on, so we've finished reading dataset. This thread is stopping.", "yellow")
-                    self._finished_reading = True
+                    break
+                elif self._mode == "train":
+                    red_print(
+                        "The share of the data of this stream is empty, it is stopping.", "yellow")
                     break
                 else:
                     raise Exception(
                         "single_pass mode is off but the example generator is\
                         out of data; error.")
 
+            if not shuffled:
+                self._positions[stream] = self._read_positions[stream]
+            pos = self._positions.get(stream)
+            if self._dedup_scope == "epoch" and pos is not None and pos.epoch != dedup_epoch:
+                # the files are shared out again every epoch, the stream
+                # moves on to the index of its new epoch
+                dedup_index = self.epoch_dedup_index(pos.epoch)
+                dedup_epoch = pos.epoch
+
+            if self._use_length_index:
+                # the records of a batch planned from the length index
+                if len(window_index) >= self._hps.batch_size * self._bucketing_cache_size:
+                    window_index.clear()
+                examples = []
+                for planned_record in record:
+                    example = self.make_example(planned_record)
+                    example.position = (stream, pos)
+                    example.source_ref = planned_record[2]
+                    if self.is_duplicate(example, planned_record[2], dedup_index) or \
+                            self.is_window_duplicate(example, window_index):
+                        self._num_duplicates += 1
+                        continue
+                    examples.append(example)
+                # as in fill_batch_queue the incomplete batches are dropped
+                if len(examples) == self._hps.batch_size or (examples and self._hps.token_budget):
+                    self._example_queue.put(examples)
+                continue
+
             # abstract_sentences = [
             #     abstract
                 # sent.strip() for sent in data.abstract2sents(abstract)
             # ]
             # Use the <s> and </s> tags in abstract to get a list of sentences.
             # Process into an Example.
-            if article and abstract:
-                example = Example(
-                    article, abstract, self._enc_vocab, self._dec_vocab, self._hps)
+            example = self.make_example(record)
+            original_ref = record[2]
+            if example is not None and self.is_duplicate(example, original_ref, dedup_index):
+                self._num_duplicates += 1
+                continue
+            if example is not None:
+                example.position = (stream, pos)
+                example.source_ref = original_ref
                 # what is the vocab here? the extended vocab?
                 # place the Example in the example queue.
                 # enc_len = len(example.enc_input)
@@ -412,6 +1128,83 @@ class GenBatcher(object):
             else:
                 red_print("something wrong may happened in putting example to queue")
 
+    def make_example(self, record):
+        """Processes a record of the generators into an Example, None for the
+        end of the data"""
+        if self._hps.use_shards:
+            enc_ids, abs_ids, original_ref = record
+            return Example.from_ids(
+                enc_ids, abs_ids, self._dec_vocab, self._hps, original_ref) if original_ref else None
+        article, abstract, original_ref = record
+        if self._lcsts:
+            # the ref locates the raw pair, the tokenized strings are kept
+            original_ref = None
+        return Example(
+            article, abstract, self._enc_vocab, self._dec_vocab, self._hps,
+            original_ref) if article and abstract else None
+
+    def epoch_dedup_index(self, epoch):
+        """The dedup index of an epoch in the "epoch" scope, shared by the
+        streams of this process. The streams cross the epoch boundaries one
+        by one, so the index of the previous epoch is kept for those still
+        reading it and the older ones are dropped."""
+        with self._dedup_lock:
+            index = self._epoch_dedup_indexes.get(epoch)
+            if index is None:
+                for old in [e for e in self._epoch_dedup_indexes if e < epoch - 1]:
+                    del self._epoch_dedup_indexes[old]
+                index = self._epoch_dedup_indexes[epoch] = {}
+            return index
+
+    def is_duplicate(self, example, original_ref, dedup_index):
+        """Checks the content hash of a training example against the dedup
+        index, which maps the hash to the location (an OriginalRef) of its
+        first occurrence. An example is a duplicate if its content was first
+        seen at another location. In the "epoch" scope the index is the one
+        of the epoch of the stream, see epoch_dedup_index. In the "global"
+        scope the index is never cleared so the duplicates across the shards
+        are removed in every epoch. Both are shared by the streams.
+
+        With worker processes the indexes live in each worker and only cover
+        the files the worker has read; as the files are shared out again
+        every epoch, a duplicate whose first occurrence was read by another
+        worker is kept, and which duplicates are removed changes from epoch
+        to epoch.
+
+        Args:
+          example: Example
+          original_ref: data.OriginalRef of the example
+          dedup_index: dict, the index of the epoch of the stream
+        """
+        if self._mode != "train" or self._dedup_scope not in ["epoch", "global"]:
+            return False
+        key = example.content_key
+        if self._dedup_scope == "global":
+            dedup_index = self._dedup_index
+        # setdefault is atomic so the shared indexes need no lock
+        return dedup_index.setdefault(key, original_ref) != original_ref
+
+    def is_window_duplicate(self, example, window_index):
+        """Checks a training example against the index of the bucketing
+        window in the "window" scope, keyed as in is_duplicate: the same
+        record read again in the window, in the next epoch or by another
+        stream, is not a duplicate.
+
+        Args:
+          example: Example
+          window_index: dict, maps the content hashes of the window to the
+            location of their first occurrence
+        """
+        if self._mode != "train" or self._dedup_scope != "window":
+            return False
+        return window_index.setdefault(example.content_key, example.source_ref) != example.source_ref
+
+    @property
+    def num_duplicates(self):
+        """Number of the training examples dropped as duplicates, those of
+        the worker processes as of the batches returned by next_batch"""
+        return self._num_duplicates
+
     def fill_batch_queue(self):
         """Takes Examples out of example queue, sorts them by encoder sequence
         length, processes into Batches and places them in the batch queue.
@@ -420,19 +1213,27 @@ class GenBatcher(object):
         repeated.
         """
         while True:
+            if self._use_length_index:
+                # the batch was planned from the length index
+                self.put_batch(self._example_queue.get())
+                continue
+
             # Get bucketing_cache_size-many batches of Examples into a list,
             # then sort
             inputs = []
+            # content hashes of the examples in the cache in the "window"
+            # scope, mapped to the location of their first occurrence
+            window_index = {}
             for l in range(self._hps.batch_size * self._bucketing_cache_size):
 
                 pair = self._example_queue.get()
                 if self._mode == "val":
                     pass
                 if pair:
-                    if self._mode == "train" and pair not in inputs:
-                        inputs.append(pair)
-                    elif self._mode in ["val", 'test']:
-                        inputs.append(pair)
+                    if self.is_window_duplicate(pair, window_index):
+                        self._num_duplicates += 1
+                        continue
+                    inputs.append(pair)
                 else:
                     inputs.append('None')
                     for _ in range(self._hps.batch_size - ((l+1) % self._hps.batch_size)):
@@ -459,9 +1260,13 @@ class GenBatcher(object):
 
             # Group the sorted Examples into batches, optionally shuffle the
             # batches, and place in the batch queue.
-            batches = []
-            for i in range(0, len(inputs), self._hps.batch_size):
-                batches.append(inputs[i:i + self._hps.batch_size])
+            if self._mode == "train" and self._hps.token_budget:
+                batches = [[inputs[i] for i in b]
+                           for b in self.token_budget_batches([len(inp) for inp in inputs])]
+            else:
+                batches = []
+                for i in range(0, len(inputs), self._hps.batch_size):
+                    batches.append(inputs[i:i + self._hps.batch_size])
             if self._mode == "train":
                 shuffle(batches)
             for b in batches:  # each b is a list of Example objects
@@ -477,68 +1282,338 @@ class GenBatcher(object):
                     #     print('end----------')
                     #     print()
                     self._batch_queue.put(None)
+                    if self._mode == "test":
+                        # the end of the data, nothing will follow
+                        return
                     continue
-                if len(b) != self._hps.batch_size:
+                if len(b) != self._hps.batch_size and not self._hps.token_budget:
                     continue
-                self._batch_queue.put(Batch(b, self._hps, self._enc_vocab, self._dec_vocab))
+                self.put_batch(b)
 
-    def watch_threads(self):
-        """Watch example queue and batch queue threads and restart if dead."""
-        while True:
-            time.sleep(60)
-            for idx, t in enumerate(self._example_q_threads):
-                if not t.is_alive():  # if the thread is dead
-                    print('Found example queue thread dead. Restarting.')
-                    new_t = Thread(target=self.fill_example_queue)
-                    self._example_q_threads[idx] = new_t
-                    new_t.daemon = True
-                    new_t.start()
-            for idx, t in enumerate(self._batch_q_threads):
-                if not t.is_alive():  # if the thread is dead
-                    print('Found batch queue thread dead. Restarting.')
-                    new_t = Thread(target=self.fill_batch_queue)
-                    self._batch_q_threads[idx] = new_t
-                    new_t.daemon = True
-                    new_t.start()
-
-    def text_generator(self):
-        """read abstract and article pairs directly from file"""
+    def put_batch(self, example_list):
+        """Builds the Batch of the examples, in a shared memory slot in a
+        worker process, and puts it into the batch queue"""
+        if self._worker_id is None:
+            batch = Batch(example_list, self._hps, self._enc_vocab, self._dec_vocab)
+        else:
+            slot, buffers = self._slots.acquire(self._worker_id)
+            batch = Batch(example_list, self._hps, self._enc_vocab, self._dec_vocab, slot, buffers)
+            self._slots.post(slot)
+            # the count of the worker is reported to the consumer
+            num_duplicates = self._num_duplicates
+            batch.num_duplicates = num_duplicates - self._reported_duplicates
+            self._reported_duplicates = num_duplicates
+        for example in example_list:
+            if example.position is None:
+                continue
+            stream, pos = example.position
+            furthest = batch.reader_positions.get(stream)
+            if furthest is None or pos[1:] > furthest[1:]:
+                batch.reader_positions[stream] = pos
+        self._batch_queue.put(batch)
+
+    def token_budget_batches(self, enc_lens):
+        """Groups the examples sorted by encoder length into batches of
+        variable sizes: the examples of a batch are in the same length bucket
+        and the padded tokens of the batch, batch size * (longest encoder
+        sequence + max_dec_steps), are within the token budget.
+
+        Args:
+          enc_lens: the encoder lengths of the examples, in increasing order
+
+        Returns:
+          batches: list of lists of indices of the examples
+        """
+        batches = []
+        batch = []
+        bucket = None
+        for i, enc_len in enumerate(enc_lens):
+            ex_bucket = bisect.bisect_right(self._bucket_boundaries, enc_len)
+            # the inputs are sorted so ex is the longest in the batch
+            tokens = (len(batch) + 1) * (enc_len + self._hps.max_dec_steps)
+            if batch and (ex_bucket != bucket or tokens > self._hps.token_budget):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+            bucket = ex_bucket
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def plan_batches(self, enc_lens):
+        """Groups the examples by their encoder lengths the way fill_batch_queue
+        does with the Examples of its cache, from the lengths alone.
+
+        Args:
+          enc_lens: numpy array of the encoder lengths of the examples
+
+        Returns:
+          batches: shuffled list of lists of indices of the examples
+        """
+        order = np.argsort(enc_lens, kind="mergesort")
+        if self._hps.token_budget:
+            batches = [order[b].tolist() for b in self.token_budget_batches(enc_lens[order].tolist())]
+        else:
+            # the incomplete batch is dropped
+            batches = [order[i:i + self._hps.batch_size].tolist()
+                       for i in range(0, len(order) - self._hps.batch_size + 1, self._hps.batch_size)]
+        shuffle(batches)
+        return batches
+
+    def get_splits(self, pos, reader):
+        """get the (file, start, end) byte ranges read by a stream in the epoch
+        of its ReaderPosition, a record belongs to the range where its line
+        starts and end is None for the end of the file.
+
+        In train mode the files are shuffled by the seed and the epoch, the
+        same way in all the ranks, and shared out between the world_size *
+        num_streams readers so that every record is read once per epoch: a
+        reader gets whole files if there are enough of them, otherwise a byte
+        range of one file.
+
+        Args:
+          pos: ReaderPosition of the stream
+          reader: index of the stream in this rank
+
+        Returns:
+          splits: list of (path, start, end)
+        """
+        filelist = sorted(glob.glob(self._data_path))  # get the list of datafiles
+        if self._mode in ["val", 'test']:
+            assert len(filelist) == 1, \
+                "in val mode the len should be 1 but %s given. the path is %s" % (len(filelist), self._data_path)
+        red_assert(filelist, 'Error: Empty filelist at %s' % self._data_path)
+        if self._mode != "train":
+            return [(ff, 0, None) for ff in filelist]
+        random.Random(pos.seed + pos.epoch).shuffle(filelist)
+        num_readers = self._hps.world_size * self._num_streams
+        reader += self._hps.rank * self._num_streams
+        if len(filelist) >= num_readers:
+            return [(ff, 0, None) for ff in filelist[reader::num_readers]]
+        # the readers of a file split it into byte ranges
+        ff = filelist[reader % len(filelist)]
+        part = reader // len(filelist)
+        num_parts = len(range(reader % len(filelist), num_readers, len(filelist)))
+        size = os.path.getsize(ff)
+        return [(ff, size * part // num_parts, size * (part + 1) // num_parts)]
+
+    def text_generator(self, reader):
+        """read abstract and article pairs directly from file, along with the
+        OriginalRef locating them. In train mode every epoch reads the splits
+        of the reader, the position is kept in self._read_positions."""
+        stream = self.stream_name(reader)
+        pos = self.start_position(stream)
         while True:
-            filelist = glob.glob(self._data_path)  # get the list of datafiles
-            if self._mode in ["val", 'test']:
-                assert len(filelist) == 1, \
-                    "in val mode the len should be 1 but %s given. the path is %s" % (len(filelist), self._data_path)
-            red_assert(filelist, 'Error: Empty filelist at %s' % self._data_path)
-            if self._mode == "train":
-                random.shuffle(filelist)
-            for ff in filelist:
-                f = open(ff, "r", 'utf-8')
+            # a stream with an empty share would loop over the epochs forever
+            num_read = 0
+            resumed = pos.file_index or pos.offset
+            splits = self.get_splits(pos, reader)
+            for file_index in range(pos.file_index, len(splits)):
+                ff, start, end = splits[file_index]
+                # read the bytes to know the offset of every line
+                f = io.open(ff, "rb")
+                offset = max(pos.offset, start)
+                if offset:
+                    # skip to the first line starting at or after the offset
+                    f.seek(offset - 1)
+                    offset += len(f.readline()) - 1
                 while True:
-                    art_abs = f.readline().strip().split("\t")
+                    if end is not None and offset >= end:
+                        # the next line belongs to the next split
+                        f.close()
+                        break
+                    line = f.readline()
+                    original_ref = data.OriginalRef(ff, offset)
+                    offset += len(line)
+                    art_abs = line.decode('utf-8').strip().split("\t")
                     if len(art_abs) != 2:
 
                         if self._mode == "val":
                             f.seek(0)
-                            yield (None, None)
+                            offset = 0
+                            yield (None, None, None)
                             continue
                         elif self._mode == 'test':
                             f.close()
-                            yield (None, None)
+                            yield (None, None, None)
                             break
                         else:
                             # for training
                             f.close()
                             # print("closing file %s" % ff)
                             break
+                    pos = pos._replace(file_index=file_index, offset=offset)
+                    self._read_positions[stream] = pos
+                    num_read += 1
                     article_text, abstract_text = art_abs
                     if article_text and abstract_text:
                         # self._files_name_dict[f.name] += 1
-                        yield (article_text, abstract_text)
+                        yield (article_text, abstract_text, original_ref)
                     else:
                         print('Found an example with empty article text. Skipping it.')
+                pos = pos._replace(file_index=file_index + 1, offset=0)
 
-                if self._mode == "train":
-                    break
+            if self._mode == "test" or not (num_read or resumed):
+                break
+            pos = pos._replace(epoch=pos.epoch + 1, file_index=0, offset=0)
+            self._read_positions[stream] = pos
+
+    def shard_generator(self, reader):
+        """read article and abstract ids from the shards compiled by
+        data.compile_shard, the text files are only used for the originals.
+        The splits and the position are the same as in text_generator."""
+        stream = self.stream_name(reader)
+        pos = self.start_position(stream)
+        while True:
+            num_read = 0
+            resumed = pos.file_index or pos.offset
+            splits = self.get_splits(pos, reader)
+            for file_index in range(pos.file_index, len(splits)):
+                ff, start, end = splits[file_index]
+                shard = data.TokenShard(ff, self._enc_vocab, self._dec_vocab)
+                first = shard.find(max(pos.offset, start))
+                last = len(shard) if end is None else shard.find(end)
+                while True:
+                    for i in range(first, last):
+                        record = shard.record(i)
+                        # any offset after the record resumes at the next one
+                        pos = pos._replace(file_index=file_index, offset=record[2].offset + 1)
+                        self._read_positions[stream] = pos
+                        num_read += 1
+                        yield record
+                    if self._mode in ["val", 'test']:
+                        yield (None, None, None)
+                    if self._mode != "val":
+                        break
+                    first = 0
+                pos = pos._replace(file_index=file_index + 1, offset=0)
+
+            if self._mode == "test" or not (num_read or resumed):
+                break
+            pos = pos._replace(epoch=pos.epoch + 1, file_index=0, offset=0)
+            self._read_positions[stream] = pos
+
+    def lcsts_generator(self, reader):
+        """read the tokenized pairs of the chunks of the raw LCSTS corpus, see
+        lcsts.LcstsSource, along with an OriginalRef of the raw pair used as
+        its location by the dedup. The chunks are shared out like the files
+        of text_generator and the position offset is the one of the raw
+        pair."""
+        stream = self.stream_name(reader)
+        pos = self.start_position(stream)
+        while True:
+            num_read = 0
+            resumed = pos.file_index or pos.offset
+            chunks = self.lcsts_splits(pos, reader)
+            for file_index in range(pos.file_index, len(chunks)):
+                for offset, article, abstract in self._lcsts.records(chunks[file_index], pos.offset):
+                    pos = pos._replace(file_index=file_index, offset=offset + 1)
+                    self._read_positions[stream] = pos
+                    num_read += 1
+                    yield (article, abstract, data.OriginalRef(self._lcsts.path, offset))
+                pos = pos._replace(file_index=file_index + 1, offset=0)
 
-            if self._mode == "test":
+            if not (num_read or resumed):
                 break
+            pos = pos._replace(epoch=pos.epoch + 1, file_index=0, offset=0)
+            self._read_positions[stream] = pos
+
+    def lcsts_splits(self, pos, reader):
+        """The LCSTS chunks read by a stream in the epoch of its position,
+        shuffled and shared out as the files of get_splits. There must be at
+        least as many chunks as readers in all the ranks."""
+        num_readers = self._hps.world_size * self._num_streams
+        red_assert(
+            self._lcsts.num_chunks >= num_readers,
+            "%s LCSTS chunks for %s readers" % (self._lcsts.num_chunks, num_readers))
+        chunks = list(range(self._lcsts.num_chunks))
+        random.Random(pos.seed + pos.epoch).shuffle(chunks)
+        return chunks[reader + self._hps.rank * self._num_streams::num_readers]
+
+    def planned_generator(self, reader):
+        """yield the records of batches planned from the length indexes: the
+        index rows of bucketing_cache_size batches of a split are grouped by
+        length and only then are the records of each batch read. The splits
+        and the position are the same as in text_generator, the position
+        moves past a window of records when its batches are planned."""
+        stream = self.stream_name(reader)
+        pos = self.start_position(stream)
+        window = self._hps.batch_size * self._bucketing_cache_size
+        while True:
+            num_read = 0
+            resumed = pos.file_index or pos.offset
+            splits = self.get_splits(pos, reader)
+            for file_index in range(pos.file_index, len(splits)):
+                ff, start, end = splits[file_index]
+                if self._hps.use_shards:
+                    shard = data.TokenShard(ff, self._enc_vocab, self._dec_vocab)
+                else:
+                    shard = data.TextShard(ff)
+                first = shard.find(max(pos.offset, start))
+                last = len(shard) if end is None else shard.find(end)
+                offsets = shard.offsets
+                art_lens = np.minimum(shard.art_lens, self._hps.max_enc_steps)
+                for window_start in range(first, last, window):
+                    rows = np.arange(window_start, min(window_start + window, last))
+                    pos = pos._replace(file_index=file_index, offset=int(offsets[rows[-1]]) + 1)
+                    self._read_positions[stream] = pos
+                    for b in self.plan_batches(art_lens[rows]):
+                        num_read += 1
+                        yield [shard.record(i) for i in rows[b]]
+                pos = pos._replace(file_index=file_index + 1, offset=0)
+
+            if not (num_read or resumed):
+                break
+            pos = pos._replace(epoch=pos.epoch + 1, file_index=0, offset=0)
+            self._read_positions[stream] = pos
+
+
+class BatchSet(object):
+    """The batches of a validation file built once, in order and without
+    threads, and kept in memory so that the evaluations only run the model.
+    next_batch returns them as a GenBatcher in val mode would: the full
+    batches of a pass over the file, then None, then from the first one
+    again."""
+
+    def __init__(self, file_name, enc_vocab, dec_vocab, hps):
+        """
+        Args:
+          file_name: the file name of the corpus, as for GenBatcher
+          hps: hyperparameters from the generator
+        """
+        data_path = os.path.join(hps.data_path, file_name) + ".txt_*"
+        filelist = glob.glob(data_path)
+        red_assert(
+            len(filelist) == 1,
+            "in val mode the len should be 1 but %s given. the path is %s" % (len(filelist), data_path))
+        start = time.time()
+        self._batches = []
+        examples = []
+        offset = 0
+        with io.open(filelist[0], "rb") as f:
+            for line in f:
+                original_ref = data.OriginalRef(filelist[0], offset)
+                offset += len(line)
+                art_abs = line.decode('utf-8').strip().split("\t")
+                if len(art_abs) != 2:
+                    # the end of the pass of the val GenBatcher
+                    break
+                article, abstract = art_abs
+                if not (article and abstract):
+                    continue
+                examples.append(Example(article, abstract, enc_vocab, dec_vocab, hps, original_ref))
+                # the last incomplete batch is dropped
+                if len(examples) == hps.batch_size:
+                    self._batches.append(Batch(examples, hps, enc_vocab, dec_vocab))
+                    examples = []
+        self._index = 0
+        print("Built the %s batches of %s in %.2f seconds" % (
+            len(self._batches), filelist[0], time.time() - start))
+
+    def next_batch(self):
+        """Returns the next batch, or None at the end of a pass"""
+        if self._index == len(self._batches):
+            self._index = 0
+            return None
+        self._index += 1
+        return self._batches[self._index - 1]
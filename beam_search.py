@@ -36,12 +36,6 @@ class Hypothesis(object):
     def __len__(self):
         return len(self._tokens)
 
-    def extend(self, token, log_prob):
-        return Hypothesis(
-            tokens=self._tokens + [token],
-            log_probs=self.log_probs + [log_prob],
-        )
-
     @property
     def log_prob(self):
         return sum(self.log_probs)
@@ -59,62 +53,146 @@ class Hypothesis(object):
         return self.log_prob / len(self._tokens)
 
 
+class BeamStore(object):
+    """The hypotheses of the beams of a batch as arrays: the token, its log
+    probability and the slot of the hypothesis it extends, its parent, at
+    every position, so that extending the beams costs the same at every step
+    and the hypotheses are only put together by following the parents."""
+
+    def __init__(self, batch_size, beam_size, max_len, start_id):
+        self.tokens = np.zeros([batch_size, beam_size, max_len], np.int64)
+        self.log_probs = np.zeros([batch_size, beam_size, max_len])
+        self.parents = np.zeros([batch_size, beam_size, max_len], np.int64)
+        self.tokens[:, :, 0] = start_id
+        # the running sums of the log probs of the hypotheses
+        self.log_prob_sums = np.zeros([batch_size, beam_size])
+
+    def extend(self, rows, pos, parents, tokens, log_probs, log_prob_sums):
+        """Sets the hypotheses of the slots of the rows at the position pos,
+        all the arguments but pos being of shape (len(rows), beam_size)"""
+        self.parents[rows, :, pos] = parents
+        self.tokens[rows, :, pos] = tokens
+        self.log_probs[rows, :, pos] = log_probs
+        self.log_prob_sums[rows] = log_prob_sums
+
+    def hypothesis(self, row, pos, slot):
+        """Returns the Hypothesis ending in the slot at the position pos"""
+        slots = np.zeros([pos + 1], np.int64)
+        slots[pos] = slot
+        for p in xrange(pos, 0, -1):
+            slots[p - 1] = self.parents[row, slots[p], p]
+        positions = np.arange(pos + 1)
+        return Hypothesis(
+            tokens=self.tokens[row, slots, positions].tolist(),
+            log_probs=self.log_probs[row, slots, positions].tolist(),
+        )
+
+
 def run_beam_search(sess, model, vocab, batch, top_k=1):
-    batch_size = model.hps.batch_size
+    """Runs the beam search of all the articles of the batch together, every
+    step decodes the beams of the unfinished articles in one sess.run over
+    [num_unfinished * beam_size] rows.
+
+    Args:
+      sess: a tf.Session
+      model: the PointerGenerator
+      vocab: the decoder vocab
+      batch: the Batch to decode
+      top_k: number of the hypotheses to return per article
+
+    Returns:
+      best_k_hyps: a list with the best Hypothesis of every article, or with
+      the list of its best top_k hypotheses if top_k is larger than 1
+    """
     beam_size = FLAGS.beam_size
     if top_k > beam_size:
         top_k = beam_size
-    attention_keys, attention_values = model.run_encoder(sess, batch)
+    max_dec_steps = model.hps.max_dec_steps
+    min_dec_steps = model.hps.min_dec_steps
+    stop_id = vocab.word2id(data.STOP_DECODING)
+    model.run_decode_encoder(sess, batch)
+    batch_size = batch.batch_size
+    num_cands = beam_size * beam_size * 2
+    # the candidates a step can take, as many as the live hypotheses and the
+    # results at most, each hypothesis having one stop among its candidates
+    num_taken = beam_size * 2
+
+    # the live hypotheses of every article, all of length steps + 1
+    store = BeamStore(batch_size, beam_size, max_dec_steps + 1, vocab.word2id(data.START_DECODING))
+    # the finished hypotheses of every article, the stop extending the parent
+    res_parents = np.zeros([batch_size, beam_size], np.int64)
+    res_log_probs = np.zeros([batch_size, beam_size])
+    res_lens = np.zeros([batch_size, beam_size], np.int64)
+    num_results = np.zeros([batch_size], np.int64)
+
+    # the decoder layer states of the rows of the unfinished articles are
+    # kept in the session, the rows continuing them are fed
+    model.reset_decode_state(sess, batch_size * beam_size)
+    state_rows = np.arange(batch_size * beam_size)
+
+    active = np.arange(batch_size)
+    steps = 0
+    while steps < max_dec_steps and len(active):
+        # the rows of the unfinished articles gather their encoder outputs
+        num_active = len(active)
+        enc_rows = np.repeat(active, beam_size)
+        latest_tokens = store.tokens[active, :, steps].reshape([num_active * beam_size])
+        topk_log_probs, topk_ids, _ = model.run_decode_step(sess, latest_tokens, enc_rows, state_rows)
+        topk_log_probs = topk_log_probs.reshape([num_active, num_cands])
+        topk_ids = topk_ids.reshape([num_active, num_cands])
+
+        cand_sums = np.repeat(store.log_prob_sums[active], beam_size * 2, axis=1) + topk_log_probs
+        if steps == 0:
+            # all the hypotheses are the start token, only the first counts
+            cand_sums[:, beam_size * 2:] = -np.inf
+        cand_scores = -(cand_sums / (steps + 2))
+        arange = np.arange(num_active)[:, None]
+        # the best candidates, ordered by hypothesis then by rank on ties as
+        # the hypotheses used to be extended
+        if num_cands > num_taken:
+            best = np.argpartition(cand_scores, num_taken - 1, axis=1)[:, :num_taken]
+        else:
+            best = np.tile(np.arange(num_cands), [num_active, 1])
+        order = best[arange, np.lexsort((best, cand_scores[arange, best]))]
+        is_stop = topk_ids[arange, order] == stop_id
+        is_result = is_stop if steps >= min_dec_steps else np.zeros_like(is_stop)
+        # the candidates are taken until the beam or the results are full
+        result_counts = num_results[active][:, None] + np.cumsum(is_result, axis=1)
+        full = (np.cumsum(~is_stop, axis=1) == beam_size) | (result_counts == beam_size)
+        taken = np.arange(num_taken) <= np.argmax(full, axis=1)[:, None]
+
+        article, pos = np.nonzero(taken & is_result)
+        if len(article):
+            rows, cands = active[article], order[article, pos]
+            slots = result_counts[article, pos] - 1
+            res_parents[rows, slots] = cands // (beam_size * 2)
+            res_log_probs[rows, slots] = topk_log_probs[article, cands]
+            res_lens[rows, slots] = steps + 2
+            num_results[active] += np.sum(taken & is_result, axis=1)
+
+        # the first beam_size taken candidates which are not stops
+        kept = order[arange, np.argsort(~(taken & ~is_stop), axis=1, kind='mergesort')[:, :beam_size]]
+        parents = kept // (beam_size * 2)
+        store.extend(
+            active, steps + 1, parents, topk_ids[arange, kept],
+            topk_log_probs[arange, kept], cand_sums[arange, kept])
+
+        # the states follow the hypotheses they are extended from
+        unfinished = num_results[active] < beam_size
+        state_rows = (arange * beam_size + parents)[unfinished].reshape([-1])
+        active = active[unfinished]
+        steps += 1
 
     best_k_hyps = []
-    batch_hyps = []
-    for i in xrange(batch_size):
-        hyps = [
-            Hypothesis(
-                tokens=[vocab.word2id(data.START_DECODING)],
-                log_probs=[0.0],
-            ) for _ in range(beam_size)]
-        batch_hyps.append(hyps)
-
     for k in xrange(batch_size):
-        hyps = batch_hyps[k]
-        enc_padding_mask = np.tile(batch.enc_padding_mask[k], (beam_size, 1))
-        attention_key = np.tile(attention_keys[k], (beam_size, 1, 1))
-        attention_value = np.tile(attention_values[k], (beam_size, 1, 1))
         results = []
-        steps = 0
-
-        while steps < model.hps.max_dec_steps and len(results) < beam_size:
-            dec_inputs = np.array([h.tokens for h in hyps])
-            topk_log_probs, topk_ids, _ = model.run_decode_onestep(
-                    sess, dec_inputs, attention_key, attention_value, enc_padding_mask,
-                )
-
-            all_hyps = []
-            num_orig_hyps = 1 if steps == 0 else len(hyps)
-            for i in xrange(num_orig_hyps):
-                h = hyps[i]
-                for j in range(beam_size * 2):
-                    new_hyp = h.extend(
-                        token=topk_ids[i, j],
-                        log_prob=topk_log_probs[i, j]
-                    )
-                    all_hyps.append(new_hyp)
-
-            hyps = []
-            for h in sort_hyps(all_hyps):
-                if h.latest_token == vocab.word2id(data.STOP_DECODING):
-                    if steps >= model.hps.min_dec_steps:
-                        results.append(h)
-                else:
-                    hyps.append(h)
-                if len(hyps) == beam_size or len(results) == beam_size:
-                    break
-
-            steps += 1
-
-        if len(results) < top_k:
-            results += hyps[:top_k - len(results)]
+        for i in xrange(num_results[k]):
+            hyp = store.hypothesis(k, res_lens[k, i] - 2, res_parents[k, i])
+            hyp.tokens.append(stop_id)
+            hyp.log_probs.append(float(res_log_probs[k, i]))
+            results.append(hyp)
+        # the articles with less results take the best live hypotheses
+        results += [store.hypothesis(k, steps, i) for i in xrange(top_k - num_results[k])]
 
         hyps_sorted = sort_hyps(results)
         if top_k == 1:
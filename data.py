@@ -21,7 +21,13 @@ from __future__ import unicode_literals, print_function
 from __future__ import absolute_import
 from __future__ import division
 
+import io
+import os
 import csv
+import struct
+import hashlib
+from collections import namedtuple
+from itertools import chain, groupby
 from termcolor import colored
 import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
@@ -49,9 +55,29 @@ NEGATIVE_LABEL = 0
 # Note: none of <s>, </s>, [PAD], [UNK], [START], [STOP] should appear in
 # the vocab file.
 
+# Handle to an article and abstract pair in a text shard. The strings are only
+# read from the file when they are needed (decode/ROUGE)
+OriginalRef = namedtuple("OriginalRef", ["path", "offset"])
+
+# The compiled vocab cache: magic, md5, size and mtime of the text vocab file,
+# max_size, number of words and blob length, followed by the int32 offsets and
+# the utf-8 blob of the words, each ended by a newline
+VOCAB_CACHE_SUFFIX = '.bin'
+VOCAB_CACHE_MAGIC = b'VOCAB002'
+VOCAB_CACHE_HEADER = struct.Struct(str('<8s16sqdqqq'))
+
 
 class Vocab(object):
-    """Vocabulary class for mapping between words and ids (integers)"""
+    """Vocabulary class for mapping between words and ids (integers)
+
+    The vocabulary is kept in a compiled form: the words are concatenated into
+    one utf-8 blob indexed by an offsets array (id -> word). The compiled form
+    is cached next to the vocab file and loaded with a single read, it is
+    rebuilt whenever the checksum of the vocab file or the max_size changes.
+    The file is only hashed when its size or mtime differ from the cached
+    ones.
+    The words are mapped back to their ids (word -> id) by a dict built once
+    after loading, the lookups being on the per token path."""
 
     def __init__(self, vocab_file, max_size):
         """Creates a vocab of up to max_size words, reading from the vocab_file.
@@ -62,9 +88,25 @@ class Vocab(object):
           "<word> <frequency>" on each line, sorted with most frequent word
           first. This code doesn't actually use the frequencies, though.
           max_size: integer. The maximum size of the resulting Vocabulary."""
-        self._word_to_id = {}
-        self._id_to_word = {}
-        self._count = 0
+        cache_file = vocab_file + VOCAB_CACHE_SUFFIX
+        stat = os.stat(vocab_file)
+        loaded, checksum = self._load_cache(cache_file, vocab_file, stat, max_size)
+        if not loaded:
+            self._build(self._read_vocab_file(vocab_file, max_size))
+        if checksum is not None:
+            # the cache was rebuilt or the vocab file touched
+            self._write_cache(cache_file, checksum, stat, max_size)
+        words = self._blob.decode('utf-8').split("\n")[:self._count]
+        self._word_to_id = dict(zip(words, xrange(self._count)))
+        self._unk_id = self._word_to_id.get(UNKNOWN_TOKEN)
+        self._codec = None
+        self._char_tables = {}
+
+    @staticmethod
+    def _read_vocab_file(vocab_file, max_size):
+        """Reads up to max_size distinct words from the text vocab file."""
+        words = []
+        seen = set()
 
         # # [UNK], [PAD], [START] and [STOP] get the ids 0,1,2,3.
         # for w in [PAD_TOKEN, UNKNOWN_TOKEN, START_DECODING, STOP_DECODING]:
@@ -78,43 +120,125 @@ class Vocab(object):
                     print('Warning: incorrectly formatted line in vocabulary file: %s\n' % line)
                     continue
                 w = pieces[0]
-                if self._count == 0:
+                if not words:
                     assert w == PAD_TOKEN, "the first vocab should be PAD"
                 # if w in [SENTENCE_START, SENTENCE_END, UNKNOWN_TOKEN, PAD_TOKEN, START_DECODING, STOP_DECODING]:
                 #     continue
                 #   # raise Exception(
                 #   #     '<s>, </s>, [UNK], [PAD], [START] and [STOP] shouldn\'t be in the vocab file, but %s is' % w)
-                if w in self._word_to_id:
+                if w in seen:
                     print(colored("%s already in the vocab, escape.." % w, "red"))
                     continue
                     # raise Exception('Duplicated word in vocabulary file: %s' % w)
-                self._word_to_id[w], self._id_to_word[len(self._id_to_word)] = len(self._word_to_id), w
-                self._count += 1
-                if max_size != 0 and len(self._word_to_id) >= max_size:
-                    print("max_size of vocab was specified as %i; we now have %i words. Stop reading." % (max_size, len(self._word_to_id)))
+                seen.add(w)
+                words.append(w)
+                if max_size != 0 and len(words) >= max_size:
+                    print("max_size of vocab was specified as %i; we now have %i words. Stop reading." % (max_size, len(words)))
                     break
+        return words
+
+    def _build(self, words):
+        """Compiles the list of words into the offsets and blob."""
+        encoded = [w.encode('utf-8') + b"\n" for w in words]
+        self._count = len(encoded)
+        self._offsets = np.zeros(self._count + 1, dtype=np.int32)
+        self._offsets[1:] = np.cumsum([len(e) for e in encoded])
+        self._blob = b"".join(encoded)
+
+    def _load_cache(self, cache_file, vocab_file, stat, max_size):
+        """Loads the compiled vocab from cache_file if it was built from the
+        vocab file with max_size. The vocab file is hashed only if its size
+        or mtime changed since the cache was written.
+
+        Returns:
+          loaded: False if the cache is missing or was built from another
+            vocab file or max_size
+          checksum: the md5 of the vocab file if it was computed, None if the
+            cache is up to date
+        """
+        if not os.path.exists(cache_file):
+            return False, file_checksum(vocab_file)
+        with io.open(cache_file, 'rb') as f:
+            buf = f.read()
+        if len(buf) < VOCAB_CACHE_HEADER.size:
+            return False, file_checksum(vocab_file)
+        magic, cached_checksum, size, mtime, cached_max_size, count, blob_len = \
+            VOCAB_CACHE_HEADER.unpack_from(buf)
+        if magic != VOCAB_CACHE_MAGIC or cached_max_size != max_size:
+            return False, file_checksum(vocab_file)
+        checksum = None
+        if size != stat.st_size or mtime != stat.st_mtime:
+            checksum = file_checksum(vocab_file)
+            if checksum != cached_checksum:
+                return False, checksum
+        pos = VOCAB_CACHE_HEADER.size
+        self._offsets = np.frombuffer(buf, dtype=np.int32, count=count + 1, offset=pos)
+        pos += self._offsets.nbytes
+        self._blob = buf[pos:pos + blob_len]
+        self._count = count
+        self._checksum = cached_checksum
+        return True, checksum
+
+    def _write_cache(self, cache_file, checksum, stat, max_size):
+        """Writes the compiled vocab to cache_file, the vocab still works if
+        the directory is not writable."""
+        self._checksum = checksum
+        header = VOCAB_CACHE_HEADER.pack(
+            VOCAB_CACHE_MAGIC, checksum, stat.st_size, stat.st_mtime, max_size,
+            self._count, len(self._blob))
+        tmp_file = "%s.%s.tmp" % (cache_file, os.getpid())
+        try:
+            with io.open(tmp_file, 'wb') as f:
+                f.write(header)
+                f.write(self._offsets.tobytes())
+                f.write(self._blob)
+            # rename so that concurrent readers never see a partial cache
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError) as e:
+            print(colored("failed to write the vocab cache %s: %s" % (cache_file, e), "red"))
+
+    @property
+    def checksum(self):
+        """The md5 digest of the vocab file the vocab was read from"""
+        return self._checksum
+
+    @property
+    def codec(self):
+        """The VocabCodec of this vocab, built on first use"""
+        if self._codec is None:
+            self._codec = VocabCodec(self)
+        return self._codec
+
+    def char_table(self, char_vocab):
+        """The CharTable mapping the words of this vocab to the chars of
+        char_vocab, built on first use"""
+        if id(char_vocab) not in self._char_tables:
+            self._char_tables[id(char_vocab)] = CharTable(self, char_vocab)
+        return self._char_tables[id(char_vocab)]
 
-        # print("Finished constructing vocabulary of %i total words. Last word added: %s" % (max_size, self._id_to_word[max_size-1]))
     @property
     def word_keys(self):
-        return self._word_to_id.keys()
+        return [self.id2word(i) for i in xrange(self._count)]
 
     @property
     def id_keys(self):
-        return self._id_to_word.keys()
+        return list(xrange(self._count))
 
     def word2id(self, word):
         """Returns the id (integer) of a word (string). Returns [UNK] id if word
         is OOV."""
-        if word not in self._word_to_id:
-            return self._word_to_id[UNKNOWN_TOKEN]
-        return self._word_to_id[word]
+        word_id = self._word_to_id.get(word)
+        if word_id is None:
+            if self._unk_id is None:
+                raise KeyError(UNKNOWN_TOKEN)
+            return self._unk_id
+        return word_id
 
     def id2word(self, word_id):
         """Returns the word (string) corresponding to an id (integer)."""
-        if word_id not in self._id_to_word:
+        if not 0 <= word_id < self._count:
             raise ValueError('Id not found in vocab: %d' % word_id)
-        return self._id_to_word[word_id]
+        return self._blob[self._offsets[word_id]:self._offsets[word_id + 1] - 1].decode('utf-8')
 
     def size(self):
         """Returns the total size of the vocabulary"""
@@ -133,7 +257,191 @@ class Vocab(object):
             fieldnames = ['word']
             writer = csv.DictWriter(f, delimiter="\t", fieldnames=fieldnames)
             for i in xrange(self.size()):
-                writer.writerow({"word": self._id_to_word[i]})
+                writer.writerow({"word": self.id2word(i)})
+
+
+def file_checksum(path):
+    """Returns the md5 digest of the file content."""
+    md5 = hashlib.md5()
+    with io.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+    return md5.digest()
+
+
+class VocabCodec(object):
+    """Batch counterpart of the per token helpers of this module. The batches
+    of ids are handled as 2-D numpy arrays: ids are mapped to words by
+    indexing an object array and the sequences are truncated at their first
+    [STOP] with an argmax on the mask. Use Vocab.codec to get the codec of a
+    vocab."""
+
+    def __init__(self, vocab):
+        self._size = vocab.size()
+        self._id_to_word = np.array(
+            [vocab.id2word(i) for i in xrange(self._size)], dtype=object)
+        self._word_to_id = vocab._word_to_id
+        self._unk_id = self._word_to_id.get(UNKNOWN_TOKEN)
+        self.pad_id = self._word_to_id.get(PAD_TOKEN)
+        self.stop_id = self._word_to_id.get(STOP_DECODING)
+
+    @staticmethod
+    def as_array(id_batch, pad_id=0):
+        """Returns the batch as a 2-D int array and the length of each row, a
+        list of lists of ids of different lengths is padded with pad_id."""
+        if isinstance(id_batch, np.ndarray):
+            return id_batch, np.full(len(id_batch), id_batch.shape[1], dtype=np.int64)
+        lens = np.array([len(s) for s in id_batch], dtype=np.int64)
+        ids = np.full([len(id_batch), lens.max() if len(lens) else 0], pad_id, dtype=np.int64)
+        ids[np.arange(ids.shape[1]) < lens[:, None]] = np.fromiter(
+            chain.from_iterable(id_batch), dtype=np.int64, count=lens.sum())
+        return ids, lens
+
+    @staticmethod
+    def stop_lens(ids, lens, stop_id):
+        """Returns the lengths of the rows truncated before their first
+        stop_id, the rows without stop_id keep their lengths."""
+        if ids.shape[1] == 0:
+            # argmax has no answer for zero-width rows
+            return np.zeros_like(lens)
+        is_stop = (ids == stop_id) & (np.arange(ids.shape[1]) < lens[:, None])
+        return np.where(is_stop.any(axis=1), is_stop.argmax(axis=1), lens)
+
+    def ids2words(self, id_batch, article_oovs=None, stop_id=None):
+        """Maps a batch of ids to lists of words.
+
+        Args:
+          id_batch: 2-D array or list of lists of ids
+          article_oovs: list of lists of the in-article OOVs of each row, the
+            temporary OOV ids are mapped to them. Without it they are errors.
+          stop_id: if given the rows are truncated before their first stop_id
+
+        Returns:
+          words: list of lists of words (strings)
+        """
+        ids, lens = self.as_array(id_batch, self.pad_id)
+        if stop_id is not None:
+            lens = self.stop_lens(ids, lens, stop_id)
+        invalid = (ids < 0) | (ids >= self._size)
+        out_of_vocab = (np.arange(ids.shape[1]) < lens[:, None]) & invalid
+        # the ids past the lengths may be OOVs as well
+        words = self._id_to_word[np.where(invalid, 0, ids)]
+        for b, t in zip(*np.nonzero(out_of_vocab)):
+            word_id = ids[b, t]
+            if article_oovs is None or not 0 <= word_id - self._size < len(article_oovs[b]):
+                raise ValueError('Id not found in vocab: %d' % word_id)
+            words[b, t] = article_oovs[b][word_id - self._size]
+        return [row[:l].tolist() for row, l in zip(words, lens)]
+
+    def words2ids(self, words):
+        """Maps a list of words to ids, OOVs are mapped to [UNK]."""
+        get = self._word_to_id.get
+        return [get(w, self._unk_id) for w in words]
+
+    def article2ids(self, article_words):
+        """Maps the article words to ids, numbering the article OOVs from the
+        vocab size on in the order they first appear.
+
+        Args:
+          article_words: list of words (strings)
+
+        Returns:
+          ids: list of word ids, the OOVs having their temporary article ids
+          oovs: list of the OOV words in the order of their temporary ids
+        """
+        get = self._word_to_id.get
+        oov_ids = {}
+        ids = []
+        for w in article_words:
+            i = get(w, self._unk_id)
+            if i == self._unk_id:
+                i = oov_ids.get(w)
+                if i is None:
+                    i = oov_ids[w] = self._size + len(oov_ids)
+            ids.append(i)
+        return ids, sorted(oov_ids, key=oov_ids.get)
+
+    def show_art_oovs(self, articles):
+        """Returns the articles, strings of words joined by spaces, with their
+        OOVs marked as __word__."""
+        get = self._word_to_id.get
+        return [' '.join(w if get(w, self._unk_id) != self._unk_id else "__%s__" % w
+                         for w in article.split(' '))
+                for article in articles]
+
+
+class CharTable(object):
+    """Maps the word ids of a word vocab, the generator one, to the char ids of
+    a char vocab, the discriminator one, for batches at once. The chars of
+    every word, as split by text2charlist keeping [UNK] whole, are stored in
+    CSR layout: the chars of word i are chars[starts[i]:starts[i + 1]]. Use
+    Vocab.char_table to get the table of a pair of vocabs."""
+
+    def __init__(self, word_vocab, char_vocab, keep_word=UNKNOWN_TOKEN):
+        self._word_size = word_vocab.size()
+        self._char_codec = char_vocab.codec
+        self._keep_word = keep_word
+        char_ids = [self.word_chars(w) for w in word_vocab.codec.ids2words(
+            [list(xrange(self._word_size))])[0]]
+        self.lens = np.array([len(c) for c in char_ids], dtype=np.int64)
+        self.starts = np.concatenate([[0], np.cumsum(self.lens)])
+        self.chars = np.fromiter(chain.from_iterable(char_ids), dtype=np.int64, count=self.starts[-1])
+
+    def word_chars(self, word):
+        """The char ids of a word"""
+        return self._char_codec.words2ids(text2charlist([word], keep_word=self._keep_word))
+
+    def _oov_word(self, word_id, article_oovs, row):
+        if article_oovs is None or not 0 <= word_id - self._word_size < len(article_oovs[row]):
+            raise ValueError('Id not found in vocab: %d' % word_id)
+        return article_oovs[row][word_id - self._word_size]
+
+    def convert(self, id_batch, max_len, article_oovs=None, stop_id=None):
+        """Maps a batch of word ids to a batch of char ids with numpy gathers.
+
+        Args:
+          id_batch: 2-D array or list of lists of word ids
+          max_len: the length of the char rows, longer rows are truncated and
+            shorter ones padded with 0
+          article_oovs: list of lists of the in-article OOVs of each row, the
+            temporary OOV ids are mapped to their chars
+          stop_id: if given the rows are truncated before their first stop_id
+
+        Returns:
+          char_ids: int64 array of shape (batch size, max_len)
+        """
+        ids, lens = VocabCodec.as_array(id_batch)
+        if stop_id is not None:
+            lens = VocabCodec.stop_lens(ids, lens, stop_id)
+        rows, cols = np.nonzero(np.arange(ids.shape[1]) < lens[:, None])
+        tokens = ids[rows, cols]
+        starts, word_lens, chars = self.starts[:-1], self.lens, self.chars
+        oov = (tokens < 0) | (tokens >= self._word_size)
+        if oov.any():
+            # the article OOVs are appended to the table for this batch
+            oov_chars = [self.word_chars(self._oov_word(t, article_oovs, r))
+                         for r, t in zip(rows[oov], tokens[oov])]
+            oov_lens = np.array([len(c) for c in oov_chars], dtype=np.int64)
+            starts = np.concatenate([starts, len(chars) + np.cumsum(oov_lens) - oov_lens])
+            word_lens = np.concatenate([word_lens, oov_lens])
+            chars = np.concatenate([chars, np.fromiter(
+                chain.from_iterable(oov_chars), dtype=np.int64, count=oov_lens.sum())])
+            tokens = tokens.copy()
+            tokens[oov] = self._word_size + np.arange(oov.sum())
+        # the chars of the tokens one after another, their token and their
+        # position in the flattened chars of the row
+        token_lens = word_lens[tokens]
+        token_ends = np.cumsum(token_lens)
+        char_token = np.repeat(np.arange(len(tokens)), token_lens)
+        flat = np.arange(token_ends[-1] if len(tokens) else 0)
+        gather = starts[tokens][char_token] + flat - (token_ends - token_lens)[char_token]
+        row_lens = np.bincount(rows, weights=token_lens, minlength=len(ids)).astype(np.int64)
+        char_rows = rows[char_token]
+        char_cols = flat - (np.cumsum(row_lens) - row_lens)[char_rows]
+        keep = char_cols < max_len
+        char_ids = np.zeros([len(ids), max_len], dtype=np.int64)
+        char_ids[char_rows[keep], char_cols[keep]] = chars[gather[keep]]
+        return char_ids
 
 
 def article2ids(article_words, vocab):
@@ -152,27 +460,7 @@ def article2ids(article_words, vocab):
       oovs:
         A list of the OOV words in the article (strings), in the order
         corresponding to their temporary article OOV numbers."""
-    ids = []
-    oovs = []
-    unk_id = vocab.word2id(UNKNOWN_TOKEN)
-    for w in article_words:
-        i = vocab.word2id(w)
-        if i == unk_id:  # If w is OOV
-            if w not in oovs:  # Add to list of OOVs
-                oovs.append(w)
-            # This is 0 for the first article OOV, 1 for the second article
-            # OOV...
-            oov_num = oovs.index(w)
-            # This is e.g. 50000 for the first article OOV, 50001 for the
-            # second...
-            ids.append(vocab.size() + oov_num)
-            # so those words whose ids are bigger than the vocab size are oovs.
-            # soo
-            # amazing
-        else:
-            ids.append(i)
-    return ids, oovs
-
+    return vocab.codec.article2ids(article_words)
 
 def abstract2ids(abstract_words, vocab, article_oovs):
     """Map the abstract words to their ids. In-article OOVs are mapped to their
@@ -195,7 +483,7 @@ def abstract2ids(abstract_words, vocab, article_oovs):
     return ids
 
 
-def outputsids2words(id_ar, vocab):
+def outputsids2words(id_ar, vocab, article_oovs=None):
     """Maps output ids to words, including mapping in-article OOVs from their
     temporary ids to the original OOV string (applicable in pointer-generator
     mode).
@@ -203,33 +491,17 @@ def outputsids2words(id_ar, vocab):
     Args:
       id_ar: a 2-D array of ids
       vocab: Vocabulary object
+      article_oovs: list of lists of the in-article OOVs, or None
 
     Returns:
       words: list of words (strings)
     """
-    words_lists = []
-    for j, id_list in enumerate(id_ar):
-        words = []
-        for i in id_list:
-            w = vocab.id2word(i)  # might be [UNK]
-            words.append(w)
-        words_lists.append(words)
-    return words_lists
-
+    return vocab.codec.ids2words(id_ar, article_oovs)
 
 def show_art_oovs(articles, vocab):
     """Returns the article string, highlighting the OOVs by placing
     __underscores__ around them"""
-    unk_token = vocab.word2id(UNKNOWN_TOKEN)
-    out_articles = []
-    for article in articles:
-        words = article.split(' ')
-        words = [("__%s__" % w) if vocab.word2id(
-            w) == unk_token else w for w in words]
-        out_str = ' '.join(words)
-        out_articles.append(out_str)
-    return out_articles
-
+    return vocab.codec.show_art_oovs(articles)
 
 def show_abs_oovs(abstracts, vocab, article_oovs):
     """Returns the abstract string, highlighting the article OOVs with
@@ -328,41 +600,248 @@ def gen_vocab2dis_vocab(gen_ids, gen_vocab, article_oovs, dis_vocab,
     return: a two dimensional numpy array with the ids of the discriminator vocabulary
     """
     # TODO: keep the [unk] and such words
-    samples_ids = []
     assert len(gen_ids) == len(article_oovs), \
         "length of gen_ids(%s) and article_oovs(%s) are not the same" % (len(gen_ids), len(article_oovs))
-    samples_words = outputsids2words(gen_ids, gen_vocab, article_oovs, art_ids)
-    for n, sample_words in enumerate(samples_words):
-        # if print_sample:
-        #     print(print_sample + ":")
-        #     print(colored(" ".join(sample_words), "red"))
-        try:
-            fst_stop_idx = sample_words.index(STOP_MARK)  # index of the (first) [STOP] symbol
-            sample_chars = text2charlist(sample_words[:fst_stop_idx], keep_word="[UNK]")
-        except ValueError:
-            sample_chars = text2charlist(sample_words, keep_word="[UNK]")
-        if print_sample:
-            print(print_sample + ":")
-            print(str(n) + ": " + colored("\t".join(sample_words), "green"))
-        sample_ids = [dis_vocab.word2id(char) for char in sample_chars[:max_len]]
-        while len(sample_ids) < max_len:
-            sample_ids.append(0)
-        samples_ids.append(sample_ids)
+    stop_id = gen_vocab.word2id(STOP_MARK)
     if print_sample:
+        print(print_sample + ":")
+        for n, sample_words in enumerate(gen_vocab.codec.ids2words(gen_ids, article_oovs, stop_id)):
+            print(str(n) + ": " + colored("\t".join(sample_words), "green"))
         print('\n')
-    assert len(samples_words) == len(samples_ids)
-    return np.array(samples_ids)
+    return gen_vocab.char_table(dis_vocab).convert(gen_ids, max_len, article_oovs, stop_id)
+
 
+def strip_pads(id_batch, STOP_ID, keep_length=False, PAD_ID=0):
+    """Removes the first STOP_ID and everything after it from each sample.
 
-def strip_pads(id_batch, STOP_ID):
+    Args:
+      id_batch: 2-D array or list of lists of ids
+      STOP_ID: the stop symbol
+      keep_length: if True returns the 2-D array with the removed positions
+        set to PAD_ID instead of the list of the truncated lists of ids
+      PAD_ID: the pad symbol
     """
+    ids, lens = VocabCodec.as_array(id_batch, PAD_ID)
+    lens = VocabCodec.stop_lens(ids, lens, STOP_ID)
+    if keep_length:
+        ids = ids.copy()
+        ids[np.arange(ids.shape[1]) >= lens[:, None]] = PAD_ID
+        return ids
+    return [row[:l].tolist() for row, l in zip(ids, lens)]
+
+def read_original(ref):
+    """Reads the (article, abstract) strings referred by an OriginalRef"""
+    with io.open(ref.path, 'rb') as f:
+        f.seek(ref.offset)
+        line = f.readline().decode('utf-8')
+    article, abstract = line.strip().split("\t")
+    return article, abstract
+
+
+def read_originals(refs):
+    """Reads the strings referred by many OriginalRefs, opening every file
+    once and reading it in the order of the offsets.
+
+    Returns:
+      originals: dict mapping each OriginalRef to its (article, abstract)
     """
-    new_batch = []
-    for sample_ids in id_batch:
-        try:
-            fst_stop_idx = sample_ids.index(STOP_ID)  # index of the (first) [STOP] symbol
-            sample_ids = sample_ids[:fst_stop_idx]
-        except ValueError:
-            sample_ids = sample_ids
-        new_batch.append(sample_ids)
-    return new_batch
+    originals = {}
+    for path, path_refs in groupby(sorted(set(refs)), key=lambda ref: ref.path):
+        with io.open(path, 'rb') as f:
+            for ref in path_refs:
+                f.seek(ref.offset)
+                article, abstract = f.readline().decode('utf-8').strip().split("\t")
+                originals[ref] = (article, abstract)
+    return originals
+
+
+def shard_paths(text_file):
+    """Returns the paths of the token ids and the index compiled from the text
+    shard, e.g. train.txt_3 -> (train.ids_3.npy, train.idx_3.npz). The names
+    do not match the *.txt_* pattern of the text shards."""
+    dire, name = os.path.split(text_file)
+    prefix, _, num = name.rpartition(".txt_")
+    return (os.path.join(dire, "%s.ids_%s.npy" % (prefix, num)),
+            os.path.join(dire, "%s.idx_%s.npz" % (prefix, num)))
+
+
+def vocabs_signature(enc_vocab, dec_vocab):
+    """Returns the hex digest identifying the vocabularies the ids of a shard
+    are mapped with: the checksums of their files and their sizes"""
+    md5 = hashlib.md5()
+    for vocab in (enc_vocab, dec_vocab):
+        md5.update(vocab.checksum)
+        md5.update(struct.pack(str('<q'), vocab.size()))
+    return md5.hexdigest()
+
+
+def length_index_path(text_file):
+    """Returns the path of the length index of the text shard, e.g.
+    train.txt_3 -> train.len_3.npy"""
+    dire, name = os.path.split(text_file)
+    prefix, _, num = name.rpartition(".txt_")
+    return os.path.join(dire, "%s.len_%s.npy" % (prefix, num))
+
+
+def compile_length_index(text_file):
+    """Compiles the length index of a text shard: an int64 array with a row
+    (byte offset, article length, abstract length) for each well formed line,
+    the lengths are in words before truncation. It does not depend on the
+    vocabularies so it is built once with the data.
+
+    Returns:
+      the length index
+    """
+    index = []
+    offset = 0
+    with io.open(text_file, 'rb') as f:
+        for line in f:
+            art_abs = line.decode('utf-8').strip().split("\t")
+            if len(art_abs) == 2 and art_abs[0] and art_abs[1]:
+                index.append((offset, len(art_abs[0].split()), len(art_abs[1].split())))
+            offset += len(line)
+    index = np.array(index, dtype=np.int64).reshape([-1, 3])
+    # the readers may build a missing index concurrently, a rename is atomic
+    index_path = length_index_path(text_file)
+    tmp_path = "%s.%s.tmp" % (index_path, os.getpid())
+    with io.open(tmp_path, 'wb') as f:
+        np.save(f, index)
+    os.rename(tmp_path, index_path)
+    return index
+
+
+def load_length_index(text_file):
+    """Returns the length index of the text shard, compiling it if it is
+    missing or older than the text shard"""
+    index_path = length_index_path(text_file)
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(text_file):
+        return np.load(index_path)
+    return compile_length_index(text_file)
+
+
+def compile_shard(text_file, enc_vocab, dec_vocab):
+    """Compiles a text shard, one "article\tabstract" pair per line, into a
+    flat int32 array of token ids and an int64 index. The sequences are not
+    truncated so the shards can be used with any max_enc_steps/max_dec_steps,
+    but they have to be compiled again if the vocabularies change: the index
+    keeps the vocabs_signature and TokenShard rejects a shard compiled with
+    other vocabularies.
+
+    Each row of the index is (start, article length, abstract length, byte
+    offset of the line in text_file): the article ids are
+    ids[start:start+art_len] and the abstract ids follow right after them.
+
+    Args:
+      text_file: path to the text shard
+      enc_vocab: Vocabulary object for the articles
+      dec_vocab: Vocabulary object for the abstracts
+
+    Returns:
+      the number of compiled records
+    """
+    ids = []
+    index = []
+    offset = 0
+    with io.open(text_file, 'rb') as f:
+        for line in f:
+            art_abs = line.decode('utf-8').strip().split("\t")
+            if len(art_abs) == 2 and art_abs[0] and art_abs[1]:
+                article_ids = [enc_vocab.word2id(w) for w in art_abs[0].split()]
+                abstract_ids = [dec_vocab.word2id(w) for w in art_abs[1].split()]
+                index.append((len(ids), len(article_ids), len(abstract_ids), offset))
+                ids.extend(article_ids)
+                ids.extend(abstract_ids)
+            else:
+                print('Found an incorrectly formatted line at %s of %s. Skipping it.' % (offset, text_file))
+            offset += len(line)
+
+    ids_path, idx_path = shard_paths(text_file)
+    np.save(ids_path, np.array(ids, dtype=np.int32))
+    np.savez(idx_path, index=np.array(index, dtype=np.int64).reshape([-1, 4]),
+             vocabs=np.array(vocabs_signature(enc_vocab, dec_vocab)))
+    return len(index)
+
+
+class TokenShard(object):
+    """A compiled shard. The token ids are memory mapped and the records are
+    built by slicing, no string is processed."""
+
+    def __init__(self, text_file, enc_vocab, dec_vocab):
+        """
+        Args:
+          text_file: path to the text shard the shard was compiled from
+          enc_vocab: Vocabulary object for the articles
+          dec_vocab: Vocabulary object for the abstracts, both must be the
+            ones the shard was compiled with
+        """
+        ids_path, idx_path = shard_paths(text_file)
+        self._text_file = text_file
+        self._ids = np.load(ids_path, mmap_mode='r')
+        with np.load(idx_path) as idx:
+            self._index = idx["index"]
+            signature = str(idx["vocabs"])
+        if signature != vocabs_signature(enc_vocab, dec_vocab):
+            raise ValueError(
+                "%s was compiled with other vocabularies, run dataprocess/compile_shards.py again" % idx_path)
+
+    def __len__(self):
+        return len(self._index)
+
+    def find(self, offset):
+        """Returns the index of the first record whose byte offset in the
+        text file is not less than offset"""
+        return int(np.searchsorted(self._index[:, 3], offset))
+
+    @property
+    def offsets(self):
+        """The byte offsets of the records in the text file"""
+        return self._index[:, 3]
+
+    @property
+    def art_lens(self):
+        """The untruncated article lengths of the records"""
+        return self._index[:, 1]
+
+    def record(self, i):
+        """Returns the article ids, the abstract ids and the OriginalRef of the
+        i-th record"""
+        start, art_len, abs_len, offset = self._index[i]
+        abs_start = start + art_len
+        return (self._ids[start:abs_start],
+                self._ids[abs_start:abs_start + abs_len],
+                OriginalRef(self._text_file, int(offset)))
+
+
+class TextShard(object):
+    """A text shard read through its length index, with the same interface as
+    TokenShard. The records are read by seeking to their offsets so that only
+    the needed lines are read."""
+
+    def __init__(self, text_file):
+        self._text_file = text_file
+        self._index = load_length_index(text_file)
+        self._file = io.open(text_file, 'rb')
+
+    def __len__(self):
+        return len(self._index)
+
+    def find(self, offset):
+        """Returns the index of the first record whose byte offset is not
+        less than offset"""
+        return int(np.searchsorted(self._index[:, 0], offset))
+
+    @property
+    def offsets(self):
+        return self._index[:, 0]
+
+    @property
+    def art_lens(self):
+        return self._index[:, 1]
+
+    def record(self, i):
+        """Returns the article, the abstract and the OriginalRef of the i-th
+        record"""
+        offset = int(self._index[i, 0])
+        self._file.seek(offset)
+        article, abstract = self._file.readline().decode('utf-8').strip().split("\t")
+        return article, abstract, OriginalRef(self._text_file, offset)
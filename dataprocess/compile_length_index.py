@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import sys
+import glob
+import time
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from data import compile_length_index  # noqa
+
+# compile the length index of every text shard, (offset, article length,
+# abstract length) for each record. It is used by the GenBatcher with
+# --use_length_index and by corpus_stats.py, and does not depend on the
+# vocabularies so it is built once with the data
+# python compile_length_index.py data_path
+# python dataprocess/compile_length_index.py ./data/
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("USAGE: python compile_length_index.py <data_path>")
+        sys.exit()
+
+    for text_file in sorted(glob.glob(os.path.join(sys.argv[1], "*.txt_*"))):
+        start = time.time()
+        index = compile_length_index(text_file)
+        print("indexed %s records of %s in %.2f seconds" % (len(index), text_file, time.time() - start))
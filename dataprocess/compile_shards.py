@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import sys
+import glob
+import time
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from data import Vocab, compile_shard  # noqa
+
+# compile the text shards into token id shards to be read by the GenBatcher
+# with --use_shards, it should be run again whenever the vocabularies change
+# python compile_shards.py data_path enc_vocab_size dec_vocab_size
+# python dataprocess/compile_shards.py ./data/ 500000 7500
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print("USAGE: python compile_shards.py <data_path> <enc_vocab_size> <dec_vocab_size>")
+        sys.exit()
+    data_path = sys.argv[1]
+    enc_vocab = Vocab(os.path.join(data_path, "enc_vocab"), int(sys.argv[2]))
+    dec_vocab = Vocab(os.path.join(data_path, "dec_vocab"), int(sys.argv[3]))
+
+    for text_file in sorted(glob.glob(os.path.join(data_path, "*.txt_*"))):
+        start = time.time()
+        num = compile_shard(text_file, enc_vocab, dec_vocab)
+        print("compiled %s records of %s in %.2f seconds" % (num, text_file, time.time() - start))
@@ -4,34 +4,39 @@ from __future__ import unicode_literals, print_function
 from __future__ import absolute_import
 from __future__ import division
 
+import os
+import sys
 import numpy as np
 import glob
 from codecs import open
-from collections import defaultdict as dd
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from data import load_length_index, read_original, OriginalRef  # noqa
+
+# the lengths are read from the length indexes (see compile_length_index.py),
+# which are built for the files that miss them
 
 log_file = open('corpus_log', 'a', 'utf-8')
 data_path = "./data/*.txt_*"
 filelist = glob.glob(data_path)
 
-len_art = []
-len_abs = []
-leng_dic = dd(lambda: [])
-
+indexes = []
 for ff in filelist:
-    with open(ff, 'r', 'utf-8') as f:
-        for line in f:
-            art, _abs = line.strip().split("\t")
-            art_l = len(art.split())
-            abs_l = len(_abs.split())
-            leng_dic[art_l] += [abs_l]
-            if art_l < 20:
-                print('art')
-                print(art)
-            if abs_l < 2:
-                print('abs')
-                print(_abs)
-            len_art.append(art_l)
-            len_abs.append(abs_l)
+    index = load_length_index(ff)
+    # only the short records are read from the text
+    for offset in index[(index[:, 1] < 20) | (index[:, 2] < 2), 0]:
+        art, _abs = read_original(OriginalRef(ff, int(offset)))
+        if len(art.split()) < 20:
+            print('art')
+            print(art)
+        if len(_abs.split()) < 2:
+            print('abs')
+            print(_abs)
+    indexes.append(index)
+
+index = np.concatenate(indexes)
+len_art = index[:, 1]
+len_abs = index[:, 2]
 
 
 log_file.write("the mean of art: %s" % float(np.mean(len_art)))
@@ -54,14 +59,17 @@ log_file.write("the min of abs: %s" % float(np.min(len_abs)))
 log_file.write("\n")
 log_file.write("\n")
 
-for l in leng_dic:
-    log_file.write("the mean length of abs for art which is of length: %s: %s" % (l, float(np.mean(leng_dic[l]))))
+# the abstract lengths grouped by the article length
+order = np.argsort(len_art, kind="mergesort")
+arts, starts = np.unique(len_art[order], return_index=True)
+for l, leng_abs in zip(arts, np.split(len_abs[order], starts[1:])):
+    log_file.write("the mean length of abs for art which is of length: %s: %s" % (l, float(np.mean(leng_abs))))
     log_file.write("\n")
-    log_file.write("the std length of abs for art which is of length: %s: %s" % (l, float(np.std(leng_dic[l]))))
+    log_file.write("the std length of abs for art which is of length: %s: %s" % (l, float(np.std(leng_abs))))
     log_file.write("\n")
-    log_file.write("the max length of abs for art which is of length: %s: %s" % (l, float(np.max(leng_dic[l]))))
+    log_file.write("the max length of abs for art which is of length: %s: %s" % (l, float(np.max(leng_abs))))
     log_file.write("\n")
-    log_file.write("the min length of abs for art which is of length: %s: %s" % (l, float(np.min(leng_dic[l]))))
+    log_file.write("the min length of abs for art which is of length: %s: %s" % (l, float(np.min(leng_abs))))
     log_file.write("\n")
     log_file.write("\n")
 
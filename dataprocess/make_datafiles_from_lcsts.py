@@ -21,6 +21,7 @@ tokenizer = JiebaTokenizer()
 standardizor = Standardizer()
 sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from lcsts import lcsts_records, MIN_ART_LEN, MIN_ABS_LEN
 
 # ------variables--------------------
 ENC_SEGMENT = True
@@ -67,83 +68,50 @@ def get_pairs_from_lcsts(filePath, enc_segment=False, dec_segment=False):
 
     # training set
     # f     = open('./dataset/LCSTS/PART_I/PART_full.txt', 'r')
-    f = open(filePath, 'r', 'utf-8')
-
-    line = f.readline().strip()
     lines = 0
-    flag = 0
-    while line:
-        if line == '<summary>':
-            summary = f.readline().strip()
-            if flag != 0:
-                print(summary)
-                raise Exception("something went wrong in %s" % filePath)
-            if f.readline().strip() != "</summary>":
-                print(summary)
-                raise Exception("something went wrong in %s" % filePath)
-            flag = 1
-
-            if dec_segment:
-                summary = process_line(summary)
-            else:
-                summary = text2charlist(summary)
-
-            line = f.readline().strip()
-
-        elif line == '<short_text>':
-            text = f.readline().strip()
-            if flag != 1:
-                print(summary)
-                raise Exception("something went wrong in %s" % filePath)
-            if f.readline().strip() != "</short_text>":
-                print(text)
-                raise Exception("something went wrong in %s" % filePath)
-            flag = 0
-
-            if enc_segment:
-                text = process_line(text)
-            else:
-                text = text2charlist(text)
-            line = f.readline().strip()
+    for _, text, summary in lcsts_records(filePath):
+        if dec_segment:
+            summary = process_line(summary)
+        else:
+            summary = text2charlist(summary)
 
+        if enc_segment:
+            text = process_line(text)
         else:
-            line = f.readline().strip()
+            text = text2charlist(text)
+
+        dont_yield = 0
+        abs_l = len(summary)
+        len_abs.append(abs_l)
+        if abs_l < MIN_ABS_LEN:
+            log_file.write(filePath)
+            log_file.write('\n')
+            log_file.write('summary')
+            log_file.write('\n')
+            log_file.write(" ".join(summary))
+            log_file.write('\n')
+            log_file.write('\n')
+            dont_yield = 1
+        art_l = len(text)
+        len_art.append(art_l)
+        if art_l < MIN_ART_LEN:
+            log_file.write(filePath)
+            log_file.write('\n')
+            log_file.write('text')
+            log_file.write('\n')
+            log_file.write(" ".join(text))
+            log_file.write('\n')
+            log_file.write('\n')
+            dont_yield = 1
+        pair = (text, summary)
+        if dont_yield:
             continue
+        else:
+            lines += 1
+            if lines % 200000 == 0:
+                print(lines)
+            yield pair
 
-        if flag == 0:
-            dont_yield = 0
-            abs_l = len(summary)
-            len_abs.append(abs_l)
-            if abs_l <= 3:
-                log_file.write(filePath)
-                log_file.write('\n')
-                log_file.write('summary')
-                log_file.write('\n')
-                log_file.write(" ".join(summary))
-                log_file.write('\n')
-                log_file.write('\n')
-                dont_yield = 1
-            art_l = len(text)
-            len_art.append(art_l)
-            if art_l < 20:
-                log_file.write(filePath)
-                log_file.write('\n')
-                log_file.write('text')
-                log_file.write('\n')
-                log_file.write(" ".join(text))
-                log_file.write('\n')
-                log_file.write('\n')
-                dont_yield = 1
-            pair = (text, summary)
-            if dont_yield:
-                continue
-            else:
-                lines += 1
-                if lines % 200000 == 0:
-                    print(lines)
-                yield pair
-
-    f.close()
     print(lines)
 
 
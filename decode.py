@@ -37,7 +37,6 @@ from codecs import open
 # import gen_utils
 import numpy as np
 import logging
-from six.moves import xrange
 from data import PAD_TOKEN, STOP_DECODING
 # import numpy as np
 FLAGS = tf.app.flags.FLAGS
@@ -87,7 +86,7 @@ class Decoder(object):
 
     def mc_generate(self, batch, s_num=4):
         # Run beam search to get best Hypothesis
-        attention_keys, n_hyps_batch = monte_carlo_search.run_monte_carlo_search(
+        n_hyps_batch = monte_carlo_search.run_monte_carlo_search(
             self._sess, self._model, self._vocab, batch, s_num=s_num)
 
         padded_n_hyps = []
@@ -116,44 +115,7 @@ class Decoder(object):
             for i in np.split(padding_mask, padding_mask.shape[1], 1)]
         assert len(outputs_ids) == s_num
 
-        return attention_keys, outputs_ids, padding_mask
-
-    def multinomial_decode(self, sess, model, batch, vocab):
-        batch_size = len(batch.enc_batch_extend_vocab)
-        ran_ids = []
-        id_mappings = []
-        enc_states, dec_in_state = model.run_encoder(sess, batch)
-        latest_tokens = batch_size * [vocab.word2id(data.START_DECODING)]
-        prev_coverage = np.zeros([batch.enc_batch.shape[1]])
-        dec_state = dec_in_state
-
-        steps = 0
-        while steps < self._hps.max_dec_steps:
-            ran_ids.append(latest_tokens)
-            latest_tokens = [
-                t if t in xrange(
-                    vocab.size()) else vocab.word2id(data.UNKNOWN_TOKEN)
-                for t in latest_tokens]
-            latest_tokens = np.transpose(np.array([latest_tokens]))
-            ran_id, _, dec_state, _, _, prev_coverage = model.run_decode_onestep(
-                sess=sess, enc_batch_extend_vocab=batch.enc_batch_extend_vocab,
-                max_art_oovs=batch.max_art_oovs, latest_tokens=latest_tokens,
-                enc_states=enc_states, enc_padding_mask=batch.enc_padding_mask,
-                dec_init_states=dec_state, prev_coverage=prev_coverage,
-                method="mc"
-            )
-            latest_tokens = ran_id.tolist()
-
-        stop_id = vocab.word2id(data.STOP_DECODING)
-        for ran_id in ran_ids:
-            m = ran_id.index(stop_id)
-            if m:
-                id_mapping = [1] * (m+1) + (len(ran_id) - m - 1) * [0]
-            else:
-                id_mapping = [1] * len(ran_id)
-            id_mappings.append(id_mapping)
-
-        return enc_states, dec_in_state, np.array(ran_ids), np.array(id_mappings)
+        return outputs_ids, padding_mask
 
     def bs_decode(self, batcher, save2file=True, single_pass=True, sample_rate=0):
         """Decode examples until data is exhausted (if self._hps.single_pass) and
@@ -204,9 +166,10 @@ class Decoder(object):
                 sample_n = randint(0, batch_size)
                 if sample == 1:
                     print()
+                # Remove the [STOP] token from decoded_words, if necessary
                 try:
-                    decoded_words_list = outputsids2words(
-                        outputs_ids, self._vocab)
+                    decoded_words_list = self._vocab.codec.ids2words(
+                        outputs_ids, stop_id=self._vocab.codec.stop_id)
                 except:
                     print(outputs_ids)
                     raise
@@ -214,11 +177,6 @@ class Decoder(object):
                 decoded_outputs = []
 
                 for s_n, decoded_words in enumerate(decoded_words_list):
-                    try:
-                        fst_stop_idx = decoded_words.index(data.STOP_DECODING)
-                        decoded_words = decoded_words[:fst_stop_idx]
-                    except ValueError:
-                        pass
                     decoded_output = ' '.join(decoded_words)
                     if sample == 1 and s_n == sample_n:
                         print("article:\t" + original_articles[sample_n])
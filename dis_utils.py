@@ -189,4 +189,4 @@ def eval_dis(batcher, decoder, discriminator):
         if not batch[0]:
             eval_batcher.reset()
             break
-        enc_states, n_samples, n_targets_padding_mask = decoder.mc_generate(batch, s_num=hps_gan.sample_num)
+        n_samples, n_targets_padding_mask = decoder.mc_generate(batch, s_num=hps_gan.sample_num)
@@ -147,6 +147,7 @@ def save_ckpt(sess, model, decoder, best_loss, best_rouge, model_dir, model_save
     """
     save model to model dir or evaluation directory
     the loss batcher is the val beatcher, while the rouge batcher is the test batcher
+    both are usually a batcher.BatchSet built once
 
     """
 
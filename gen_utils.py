@@ -4,6 +4,9 @@ from __future__ import unicode_literals, print_function
 from __future__ import absolute_import
 from __future__ import division
 import tensorflow as tf
+import os
+import glob
+import json
 import math
 import datetime
 import utils
@@ -14,6 +17,9 @@ from utils import linear
 from tensorflow.python.ops import variable_scope
 from dis_utils import convolution2d
 
+# the reading positions of the train GenBatcher are saved as <checkpoint>.batcher
+BATCHER_STATE_SUFFIX = ".batcher"
+
 
 def convert_to_coverage_model():
     """Load non-coverage checkpoint, add initialized extra variables for
@@ -74,10 +80,38 @@ def get_best_loss_from_chpt(val_dir, key_name="least_val_loss"):
     return best_loss
 
 
+def save_batcher_state(batcher, ckpt_path):
+    """Saves the reading positions of the batcher next to the checkpoint and
+    removes the ones of the checkpoints already deleted by the saver"""
+    with open(ckpt_path + BATCHER_STATE_SUFFIX, "w") as f:
+        json.dump(batcher.state(), f)
+    for state_path in glob.glob(join_path(os.path.dirname(ckpt_path), "*" + BATCHER_STATE_SUFFIX)):
+        if not tf.train.checkpoint_exists(state_path[:-len(BATCHER_STATE_SUFFIX)]):
+            os.remove(state_path)
+
+
+def load_batcher_state(ckpt_path):
+    """Loads the reading positions saved with the checkpoint, None if there is
+    no checkpoint or the checkpoint was saved without them"""
+    if not ckpt_path:
+        return None
+    state_path = ckpt_path + BATCHER_STATE_SUFFIX
+    if not os.path.exists(state_path):
+        print(colored("No batcher state saved at %s. Reading from new positions.." % state_path, 'red'))
+        return None
+    with open(state_path) as f:
+        state = json.load(f)
+    print("Restored the batcher state from" + colored(" %s", 'green') % state_path)
+    return state
+
+
 def save_ckpt(sess, model, best_loss, model_dir, model_saver,
-              val_batcher, val_dir, val_saver, global_step, gan_eval=True):
+              val_batcher, val_dir, val_saver, global_step, gan_eval=True,
+              train_batcher=None):
     """
-    save model to model dir or evaluation directory
+    save model to model dir or evaluation directory, along with the reading
+    positions of the train_batcher if given. The loss is evaluated over one
+    pass of the val_batcher, usually a batcher.BatchSet
     """
     if not val_batcher:
         return None, best_loss
@@ -109,15 +143,18 @@ def save_ckpt(sess, model, best_loss, model_dir, model_saver,
             'Found new best model with %.3f evaluation loss. Saving to %s %s' %
             (eval_loss, val_save_path,
                 datetime.datetime.now().strftime("on %m-%d at %H:%M")))
-        val_saver.save(sess, val_save_path, global_step=global_step)
+        ckpt_path = val_saver.save(sess, val_save_path, global_step=global_step)
         print("Model is saved to" + colored(" %s", 'green') % val_save_path)
         saved = True
         best_loss = eval_loss
 
     if not saved:
-        model_saver.save(sess, model_save_path, global_step=global_step)
+        ckpt_path = model_saver.save(sess, model_save_path, global_step=global_step)
         print("Model is saved to" + colored(" %s", 'yellow') % model_save_path)
 
+    if train_batcher:
+        save_batcher_state(train_batcher, ckpt_path)
+
     return eval_loss, best_loss
 
 
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains code to stream the training pairs straight from the raw
+LCSTS corpus, the <summary> and <short_text> blocks
+dataprocess/make_datafiles_from_lcsts.py reads with lcsts_records as well,
+without writing the train.txt_* files first. The corpus is read in byte range
+chunks and the tokenized pairs of every chunk are cached on disk, per
+segmentation setting, once the chunk has been read through."""
+
+from __future__ import unicode_literals, print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import io
+import os
+import threading
+from cntk.tokenizer import text2charlist
+
+# the pairs with less article or abstract tokens are dropped, here and in
+# get_pairs_from_lcsts
+MIN_ART_LEN = 20
+MIN_ABS_LEN = 4
+
+
+def segment_words(line):
+    """Segments a line into words with sourceline2words of dataprocess/utils,
+    without the digits as get_pairs_from_lcsts does. It is imported on the
+    first call since dataprocess/utils loads the tokenizers on import."""
+    from dataprocess.utils import sourceline2words
+    return sourceline2words(line, with_digits=False)
+
+
+def lcsts_records(path, start=0, end=None):
+    """Reads the raw (offset, text, summary) pairs of an LCSTS file whose
+    <summary> line starts in the byte range [start, end), the offset being
+    the one of that line. The blocks must alternate and be closed, otherwise
+    an Exception is raised.
+
+    Args:
+      path: the LCSTS file, e.g. PART_I.txt
+      start: byte offset, a pair it cuts is skipped
+      end: byte offset or None for the end of the file
+    """
+    with io.open(path, 'rb') as f:
+        offset = start
+        if start:
+            # skip to the first line starting at or after start
+            f.seek(start - 1)
+            offset += len(f.readline()) - 1
+        summary_offset = summary = None
+        # the first <short_text> may belong to a summary before start
+        cut = bool(start)
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            line_offset = offset
+            offset += len(line)
+            tag = line.strip()
+            if tag not in (b"<summary>", b"<short_text>"):
+                continue
+            content = f.readline()
+            closing = f.readline()
+            offset += len(content) + len(closing)
+            if closing.strip() != b"</" + tag[1:]:
+                raise Exception("something went wrong in %s at %s" % (path, line_offset))
+            if tag == b"<summary>":
+                if end is not None and line_offset >= end:
+                    break
+                if summary is not None:
+                    raise Exception("something went wrong in %s at %s" % (path, line_offset))
+                summary_offset, summary = line_offset, content.decode('utf-8').strip()
+            elif summary is not None:
+                yield summary_offset, content.decode('utf-8').strip(), summary
+                summary = None
+            elif not cut:
+                raise Exception("something went wrong in %s at %s" % (path, line_offset))
+            cut = False
+
+
+class LcstsSource(object):
+    """The training pairs of a raw LCSTS file split into num_chunks byte range
+    chunks. The pairs of a chunk are tokenized while it is read for the first
+    time and written to its cache file, and read from there afterwards. The
+    cache files are kept in <path>.cache/<setting>/<source>, so every
+    segmentation setting tokenizes the corpus once, and again whenever the
+    size or the modification time of the file changes."""
+
+    def __init__(self, path, enc_segment, dec_segment, num_chunks):
+        """
+        Args:
+          path: the LCSTS file
+          enc_segment: segment the articles into words, otherwise into chars
+          dec_segment: segment the abstracts into words, otherwise into chars
+          num_chunks: number of the chunks, the unit the readers share out
+        """
+        self.path = path
+        self.num_chunks = num_chunks
+        self._enc_segment = enc_segment
+        self._dec_segment = dec_segment
+        setting = "enc_%s-dec_%s" % (
+            "words" if enc_segment else "chars", "words" if dec_segment else "chars")
+        stat = os.stat(path)
+        source = "size_%s-mtime_%s" % (stat.st_size, int(stat.st_mtime))
+        self._cache_dir = os.path.join(path + ".cache", setting, source)
+        if not os.path.exists(self._cache_dir):
+            try:
+                os.makedirs(self._cache_dir)
+            except OSError:  # made by another process meanwhile
+                pass
+        self._size = stat.st_size
+
+    def chunk_range(self, chunk):
+        return self._size * chunk // self.num_chunks, self._size * (chunk + 1) // self.num_chunks
+
+    def cache_path(self, chunk):
+        return os.path.join(self._cache_dir, "chunk_%s_of_%s" % (chunk, self.num_chunks))
+
+    def tokenize(self, text, summary):
+        """Returns the article and abstract tokens joined by spaces, or None
+        if the pair is too short"""
+        art_tokens = segment_words(text) if self._enc_segment else text2charlist(text)
+        abs_tokens = segment_words(summary) if self._dec_segment else text2charlist(summary)
+        if len(art_tokens) < MIN_ART_LEN or len(abs_tokens) < MIN_ABS_LEN:
+            return None
+        return " ".join(art_tokens), " ".join(abs_tokens)
+
+    def records(self, chunk, min_offset=0):
+        """Yields the (offset, article, abstract) of the pairs of the chunk
+        starting at or after min_offset, the article and abstract being the
+        tokens joined by spaces.
+
+        A chunk read from its start is written to a temporary file renamed to
+        the cache file at its end, so an incomplete cache file is never read
+        and two readers of the same chunk only write it twice."""
+        cache_path = self.cache_path(chunk)
+        if os.path.exists(cache_path):
+            with io.open(cache_path, 'rb') as f:
+                for line in f:
+                    offset, article, abstract = line.decode('utf-8').rstrip("\n").split("\t")
+                    if int(offset) >= min_offset:
+                        yield int(offset), article, abstract
+            return
+        start, end = self.chunk_range(chunk)
+        writer = None
+        if min_offset <= start:
+            tmp_path = "%s.tmp.%s.%s" % (cache_path, os.getpid(), threading.current_thread().ident)
+            writer = io.open(tmp_path, 'wb')
+        for offset, text, summary in lcsts_records(self.path, max(start, min_offset), end):
+            pair = self.tokenize(text, summary)
+            if pair is None:
+                continue
+            if writer:
+                writer.write(("%s\t%s\t%s\n" % (offset, pair[0], pair[1])).encode('utf-8'))
+            yield offset, pair[0], pair[1]
+        if writer:
+            writer.close()
+            os.rename(tmp_path, cache_path)
@@ -21,10 +21,14 @@ from __future__ import absolute_import
 from __future__ import division
 
 import time
+import numpy as np
 import tensorflow as tf
 # import math
 from termcolor import colored
 from attention_decoder import conv_attention_decoder
+from attention_decoder import conv_attention_decoder_step
+from attention_decoder import conv_decoder_state_shapes
+from attention_decoder import conv_attention_key_projections
 from utils import conv_encoder
 from utils import linear_mapping_weightnorm
 from codecs import open
@@ -32,6 +36,9 @@ import data
 
 FLAGS = tf.app.flags.FLAGS
 
+# number of batches the input pipeline keeps ready ahead of the training step
+INPUT_PREFETCH_BATCHES = 4
+
 
 class PointerGenerator(object):
     """A class to represent a sequence-to-sequence model for text summarization.
@@ -42,6 +49,8 @@ class PointerGenerator(object):
         self._enc_vocab = enc_vocab
         self._dec_vocab = dec_vocab
         self._log_writer = open("./pg_log", "a", "utf-8")
+        self._input_batcher = None
+        self._input_tensors = None
         vocab_ = tf.convert_to_tensor(self._dec_vocab.id_keys)
         self._unk_mask = tf.where(
             tf.equal(vocab_, self._dec_vocab.word2id(data.UNKNOWN_TOKEN)),
@@ -58,15 +67,19 @@ class PointerGenerator(object):
         else:
             max_dec_steps = hps.max_dec_steps
 
-        self.enc_batch = tf.placeholder(tf.int32, [batch_size, None], name='enc_batch')
+        if hps.mode == "pretrain_gen" and hps.input_pipeline:
+            self._add_input_pipeline()
+
+        self.enc_batch = self._input_placeholder(tf.int32, [batch_size, None], 'enc_batch')
         self.enc_temp_batch = tf.placeholder(tf.int32, [batch_size, None], name='temp_batch_for_enc_embedding')
         self.dec_temp_batch = tf.placeholder(tf.int32, [batch_size, None], name='temp_batch_for_dec_embedding')
-        self.enc_lens = tf.placeholder(tf.int32, [batch_size], name='enc_lens')
-        self.enc_padding_mask = tf.placeholder(tf.float32, [batch_size, None], name='enc_padding_mask')
+        self.enc_lens = self._input_placeholder(tf.int32, [batch_size], 'enc_lens')
+        self.enc_padding_mask = self._input_placeholder(tf.float32, [batch_size, None], 'enc_padding_mask')
 
-        self._dec_batch = tf.placeholder(tf.int32, [batch_size, max_dec_steps], name='dec_batch')
-        self.target_batch = tf.placeholder(tf.int32, [batch_size, hps.max_dec_steps], name='target_batch')
-        self.dec_padding_mask = tf.placeholder(tf.float32, [batch_size, hps.max_dec_steps], name='decoder_padding_mask')
+        self._dec_batch = self._input_placeholder(tf.int32, [batch_size, max_dec_steps], 'dec_batch')
+        self.target_batch = self._input_placeholder(tf.int32, [batch_size, hps.max_dec_steps], 'target_batch')
+        self.dec_padding_mask = self._input_placeholder(
+            tf.float32, [batch_size, hps.max_dec_steps], 'dec_padding_mask', name='decoder_padding_mask')
 
         self.cell_c = tf.placeholder(
             tf.float32, shape=[batch_size, self.hps.hidden_dim])
@@ -80,9 +93,63 @@ class PointerGenerator(object):
 
         self._eval_dec_batch = tf.placeholder(tf.int32, [batch_size, hps.max_dec_steps], name='eval_dec_batch')
 
+        # the incremental decoding, see run_decode_step
+        self._latest_tokens = tf.placeholder(tf.int32, [batch_size], name='latest_tokens')
+        # the article of every decoded row, its index in the encoded batch
+        self._enc_rows = tf.placeholder(tf.int32, [batch_size], name='enc_rows')
+        # the row of the layer states every decoded row continues
+        self._state_rows = tf.placeholder(tf.int32, [batch_size], name='state_rows')
+        self._num_state_rows = tf.placeholder(tf.int32, [], name='num_state_rows')
+
         if hps.mode in ["decode", 'train_gan'] and hps.coverage:
             self.prev_coverage = tf.placeholder(tf.float32, [None, None], name='prev_coverage')
 
+    def _add_input_pipeline(self):
+        """Add a tf.data pipeline taking the batches of the training batcher
+        in a background thread of the session and prefetching them, onto the
+        gpu where possible. The input placeholders default to its batches so
+        that the training steps need no feed_dict, while feeding them, as
+        for the validation and the decoding, still works."""
+        keys = ['enc_batch', 'enc_lens', 'enc_padding_mask', 'dec_batch', 'target_batch', 'dec_padding_mask']
+        types = (tf.int32, tf.int32, tf.float32, tf.int32, tf.int32, tf.float32)
+        shapes = tuple(tf.TensorShape([None] if k == 'enc_lens' else [None, None]) for k in keys)
+
+        def batches():
+            while True:
+                batch = self._input_batcher.next_batch()
+                if batch is None:
+                    return
+                # copied, the arrays may be views of a shared memory slot
+                # reused after the next next_batch
+                yield tuple(np.array(getattr(batch, k)) for k in keys)
+
+        dataset = tf.data.Dataset.from_generator(batches, types, shapes)
+        dataset = dataset.prefetch(INPUT_PREFETCH_BATCHES)
+        if tf.test.is_built_with_cuda() and hasattr(tf.contrib.data, "prefetch_to_device"):
+            dataset = dataset.apply(tf.contrib.data.prefetch_to_device("/gpu:0"))
+        self._input_iterator = dataset.make_initializable_iterator()
+        self._input_tensors = dict(zip(keys, self._input_iterator.get_next()))
+
+    def _input_placeholder(self, dtype, shape, key, name=None):
+        """A placeholder for the batch field key, defaulting to the batches of
+        the input pipeline if there is one."""
+        name = name or key
+        if self._input_tensors is None:
+            return tf.placeholder(dtype, shape, name=name)
+        return tf.placeholder_with_default(self._input_tensors[key], shape, name=name)
+
+    def start_input_pipeline(self, sess, batcher):
+        """Start the input pipeline on the batches of the batcher, after which
+        run_one_batch can be called without a batch.
+
+        Args:
+          sess: the tf.Session the training steps run in
+          batcher: the GenBatcher of the training data
+        """
+        assert self._input_tensors is not None, "the graph was built without the input pipeline"
+        self._input_batcher = batcher
+        sess.run(self._input_iterator.initializer)
+
     def _make_feed_dict(self, batch, just_enc=False, gan_eval=False, gan=False):
         """Make a feed dictionary mapping parts of the batch to the appropriate
         placeholders.
@@ -156,8 +223,9 @@ class PointerGenerator(object):
                 final_dists = self._conv_decoder(emb_dec_inputs, is_training=is_training)
                 decoder_scope.reuse_variables()
                 self.final_dists = final_dists
-                self.topk_log_probs, self.indices = tf.nn.top_k(tf.log(self.final_dists[0]), self.hps.beam_size * 2)
-                self._ran_id = tf.multinomial(tf.log(self.final_dists[0]), 1)
+
+                self.attention_key_projs = conv_attention_key_projections(self.attention_keys, hps.char_emb_dim)
+                self._add_decode_cache()
 
                 eval_final_dists = self._conv_decoder(emb_eval_dec_inputs, is_training=True)
 
@@ -355,11 +423,13 @@ class PointerGenerator(object):
 
     def run_one_batch(self, sess, batch, update=True, gan_eval=False):
         """Runs one training iteration. Returns a dictionary containing train
-        op, summaries, loss, global_step and (optionally) coverage loss."""
+        op, summaries, loss, global_step and (optionally) coverage loss. With
+        batch None it runs on the next batch of the input pipeline, see
+        start_input_pipeline."""
         if gan_eval:
             update = False
 
-        feed_dict = self._make_feed_dict(batch, gan_eval=gan_eval)
+        feed_dict = {} if batch is None else self._make_feed_dict(batch, gan_eval=gan_eval)
 
         to_return = {
             'global_step': self.global_step,
@@ -409,30 +479,134 @@ class PointerGenerator(object):
 
         return results['attention_keys'], results['attention_values']
 
-    def decode_onestep(self, emb_dec_inputs):
+    def _add_decode_cache(self):
+        """Add the variables keeping the encoder outputs and the decoder layer
+        states in the session during the decoding of a batch, and the step
+        updating the states in place, so that a step only feeds the new tokens
+        and fetches the top k. They are local variables, out of the
+        checkpoints, whose shapes change from batch to batch."""
+        def cache_variable(static_shape, dtype, name):
+            var = tf.Variable(
+                tf.zeros([0] * len(static_shape), dtype), trainable=False, validate_shape=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES], name=name)
+            value = tf.identity(var)
+            value.set_shape(static_shape)
+            return var, value
+
+        enc_outputs = [self.attention_values] + self.attention_key_projs + [self.enc_padding_mask]
+        enc_vars, cached_enc_outputs = [], []
+        for i, output in enumerate(enc_outputs):
+            var, value = cache_variable(
+                [None] + output.get_shape().as_list()[1:], output.dtype, 'cached_enc_output_%s' % i)
+            enc_vars.append(var)
+            cached_enc_outputs.append(value)
+        self._cache_enc_outputs = tf.group(*[
+            tf.assign(var, output, validate_shape=False)
+            for var, output in zip(enc_vars, enc_outputs)])
+
+        state_vars, states, reset_ops = [], [], []
+        for i, shape in enumerate(conv_decoder_state_shapes()):
+            var, value = cache_variable([None] + shape, tf.float32, 'cached_dec_layer_state_%s' % i)
+            state_vars.append(var)
+            # the rows continuing the states, reordered with the hypotheses
+            states.append(tf.gather(value, self._state_rows))
+            reset_ops.append(tf.assign(
+                var, tf.zeros(tf.stack([self._num_state_rows] + shape)), validate_shape=False))
+        self._reset_dec_states = tf.group(*reset_ops)
+
+        cached_enc_outputs = [
+            cached_enc_outputs[0], cached_enc_outputs[1:-1], cached_enc_outputs[-1]]
+        step_dist, new_states = self.decode_step(
+            self._latest_tokens, states, enc_rows=self._enc_rows, enc_outputs=cached_enc_outputs)
+        self._step_topk_log_probs, self._step_indices = tf.nn.top_k(tf.log(step_dist), self.hps.beam_size * 2)
+        self._step_ran_id = tf.multinomial(tf.log(step_dist), 1)
+        self._update_dec_states = tf.group(*[
+            tf.assign(var, state, validate_shape=False) for var, state in zip(state_vars, new_states)])
+
+    def run_decode_encoder(self, sess, batch):
+        """Runs the encoder for the decoding with run_decode_step, its outputs
+        and the projected attention keys of every decoder layer stay in the
+        session until the next batch, none of them is fetched.
         """
-        function: decode onestep for rollout
-        inputs:
-            the embedded input
-        """
-        final_dists = self._conv_decoder(emb_dec_inputs, is_training=False, mask=False)
-        final_dists = final_dists[0]
-        output_id = tf.squeeze(tf.cast(tf.reshape(tf.multinomial(tf.log(final_dists), 1), [self.hps.batch_size]), tf.int32))
-        return output_id
+        feed_dict = self._make_feed_dict(batch, just_enc=True)
+        sess.run(self._cache_enc_outputs, feed_dict)
 
-    def run_decode_onestep(self, sess, dec_inputs, attention_keys, attention_values, enc_padding_mask):
+    def decode_step(self, latest_tokens, layer_states, enc_rows=None, enc_outputs=None, mask=True):
+        """Decodes one new position of the sequences at inference, taking the
+        layer states of the positions before instead of the whole prefix.
 
+        Args:
+          latest_tokens: the latest token of every sequence, shape (batch_size)
+          layer_states: the layer states of the positions before, see
+            initial_decode_state
+          enc_rows: the index of the article of every sequence in the encoded
+            batch, whose keys are gathered in the graph, or None if the
+            sequences are the articles
+          enc_outputs: the attention values, the projected attention keys and
+            the encoder padding mask, those of the encoder if None
+          mask: the unknown token gets no probability if set
+
+        Returns:
+          final_dist: the vocab distribution of the new position
+          new_states: the layer states with the new position
+        """
+        if enc_outputs is None:
+            enc_outputs = [self.attention_values, self.attention_key_projs, self.enc_padding_mask]
+        attention_values, attention_key_projs, enc_padding_mask = enc_outputs
+        if enc_rows is not None:
+            attention_key_projs = [tf.gather(proj, enc_rows) for proj in attention_key_projs]
+            attention_values = tf.gather(attention_values, enc_rows)
+            enc_padding_mask = tf.gather(enc_padding_mask, enc_rows)
+        emb_dec_inputs = tf.nn.embedding_lookup(self.dec_embeddings, tf.expand_dims(latest_tokens, 1))
+        logits, new_states = conv_attention_decoder_step(
+            emb_dec_inputs, enc_padding_mask, attention_key_projs, attention_values,
+            self.hps.dec_vocab_size, layer_states)
+        final_dist = tf.nn.softmax(logits)
+        if mask:
+            final_dist *= self._unk_mask
+        return final_dist, new_states
+
+    def initial_decode_state(self, num):
+        """Returns the layer states of num sequences before their first
+        position, for decode_step."""
+        return [np.zeros([num] + shape, np.float32) for shape in conv_decoder_state_shapes()]
+
+    def reset_decode_state(self, sess, num):
+        """Sets the layer states kept in the session to those of num sequences
+        before their first position."""
+        sess.run(self._reset_dec_states, {self._num_state_rows: num})
+
+    def run_decode_step(self, sess, latest_tokens, enc_rows, state_rows):
+        """Decodes one position of the sequences from the encoder outputs and
+        the layer states kept in the session instead of the whole prefixes,
+        and keeps their new layer states.
+
+        Args:
+          latest_tokens: the latest token of every sequence
+          enc_rows: the index of the article of every sequence in the batch
+            given to run_decode_encoder
+          state_rows: the row of the states of the last step, or of
+            reset_decode_state, every sequence continues, the hypotheses
+            being reordered by it
+
+        Returns:
+          topk_log_probs: the log probabilities of the beam_size * 2 most
+            probable ids of every sequence, shape (num, beam_size * 2)
+          indices: those ids, shape (num, beam_size * 2)
+          ran_id: an id sampled from the distribution of every sequence,
+            shape (num, 1)
+        """
         feed = {
-            self._dec_batch: dec_inputs,
-            self.attention_keys: attention_keys,
-            self.attention_values: attention_values,
-            self.enc_padding_mask: enc_padding_mask,
+            self._latest_tokens: latest_tokens,
+            self._enc_rows: enc_rows,
+            self._state_rows: state_rows,
         }
 
         to_return = {
-          "topk_log_probs": self.topk_log_probs,
-          "indices": self.indices,
-          "ran_id": self._ran_id,
+          "topk_log_probs": self._step_topk_log_probs,
+          "indices": self._step_indices,
+          "ran_id": self._step_ran_id,
+          "update": self._update_dec_states,
         }
 
         results = sess.run(to_return, feed_dict=feed)
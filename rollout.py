@@ -7,7 +7,6 @@ from tensorflow.python.ops import tensor_array_ops, control_flow_ops
 import numpy as np
 from data import strip_pads
 from gan_utils import rouge_l
-from data import outputsids2words
 from data import PAD_TOKEN
 from data import START_DECODING # noqa
 from data import STOP_DECODING
@@ -39,30 +38,27 @@ class Rollout(object):
         ######################################################################
 
         with tf.variable_scope(decoder_scope, reuse=True):
-
-            def recurrence_given(i, init_start_ar):
-                init_start_ar = init_start_ar.write(i, self.sample_ar.read(i))
-                return i+1, init_start_ar
-
-            def recurrence_rollout(i, dec_input):
-                dec_input_emb = tf.nn.embedding_lookup(
-                    self.g_embeddings, tf.transpose(dec_input.stack(), [1, 0]))
-                output_id = self.generator.decode_onestep(dec_input_emb)
-                next_input = dec_input.write(i, output_id)
-                return i+1, next_input
-
-            j, init_start = control_flow_ops.while_loop(
-                cond=lambda i, _1: i < self.given_num,
-                body=recurrence_given, loop_vars=(0, rollout_sample_ar))
-
-            _, self.rollout_sample_ar = control_flow_ops.while_loop(
-                cond=lambda i, _1: i < max_dec_steps+1,
-                body=recurrence_rollout, loop_vars=(j, init_start))
+            batch_size = self._gen_hps.batch_size
+
+            def recurrence(i, dec_input, layer_states):
+                # decode the position i from the states of the positions
+                # before, it is taken from the sample if given
+                final_dist, layer_states = self.generator.decode_step(
+                    dec_input.read(i-1), layer_states, mask=False)
+                output_id = tf.cast(tf.reshape(tf.multinomial(tf.log(final_dist), 1), [batch_size]), tf.int32)
+                next_input = tf.cond(i < self.given_num, lambda: self.sample_ar.read(i), lambda: output_id)
+                return i+1, dec_input.write(i, next_input), layer_states
+
+            init_states = [
+                tf.zeros(state.shape) for state in self.generator.initial_decode_state(batch_size)]
+            _, self.rollout_sample_ar, _ = control_flow_ops.while_loop(
+                cond=lambda i, _1, _2: i < max_dec_steps+1,
+                body=recurrence, loop_vars=(1, rollout_sample_ar.write(0, self.sample_ar.read(0)), init_states))
 
         self.rollout_samples = tf.slice(tf.transpose(self.rollout_sample_ar.stack()), [0, 1], [-1, -1])
         self.rollout_samples_emb = tf.nn.embedding_lookup(self.g_embeddings, self.rollout_samples)
 
-    def get_reward(self, hps_gan, sess, dec_vocab, source_batch, enc_states, k_samples, discriminator):
+    def get_reward(self, hps_gan, sess, dec_vocab, source_batch, k_samples, discriminator):
         rollout_num = hps_gan.rollout_num
         rouge_ratio = hps_gan.rouge_reward_ratio
         dis_ratio = hps_gan.dis_reward_ratio
@@ -73,6 +69,8 @@ class Rollout(object):
         article_lens = source_batch.enc_lens
         # batch_size = int(articles.shape[0])
         stop_token = dec_vocab.word2id(STOP_DECODING)
+        pad_token = dec_vocab.word2id(PAD_TOKEN)
+        codec = dec_vocab.codec
         emb_articles = sess.run(
             self.generator.enc_temp_embedded,
             feed_dict={self.generator.enc_temp_batch: articles})
@@ -83,10 +81,7 @@ class Rollout(object):
             dis_rewards = []
             rouge_rewards = []
             no_stop_samples = strip_pads(
-                samples.tolist(),
-                stop_token,
-                keep_length=True,
-                PAD_ID=dec_vocab.word2id(PAD_TOKEN))
+                samples, stop_token, keep_length=True, PAD_ID=pad_token)
             for ir in range(rollout_num):
                 for given_num in range(hps_gan.rollout_start, max_dec_steps+1):
                     self.sample_emb_ls = []
@@ -95,17 +90,15 @@ class Rollout(object):
                     feed_dict[self.sample] = samples
                     feed_dict[self.given_num] = given_num
                     feed_dict[self.generator.enc_padding_mask] = source_batch.enc_padding_mask
-                    feed_dict[self.generator.attention_keys] = enc_states
+                    # the encoder runs on the embedded articles in the graph
                     feed_dict[self.generator.emb_enc_inputs] = emb_articles
+                    feed_dict[self.generator.enc_lens] = article_lens
 
-                    rollout_samples = sess.run([self.rollout_samples], feed_dict)
+                    rollout_samples = sess.run(self.rollout_samples, feed_dict)
                     # how about multiple generators for one discriminator?
                     if dis_ratio:
                         rollout_samples_batch = strip_pads(
-                            rollout_samples.tolist(),
-                            stop_token,
-                            keep_length=True,
-                            PAD_ID=dec_vocab.word2id(PAD_TOKEN))
+                            rollout_samples, stop_token, keep_length=True, PAD_ID=pad_token)
 
                         emb_rollout_samples = sess.run(
                             self.generator.dec_temp_embedded,
@@ -123,7 +116,7 @@ class Rollout(object):
 
                     if rouge_ratio:
                         rouge_scores = []
-                        summaries = outputsids2words(strip_pads(rollout_samples.tolist(), stop_token), dec_vocab)
+                        summaries = codec.ids2words(rollout_samples, stop_id=stop_token)
                         references = source_batch.original_abstracts
                         for s, r in zip(summaries, references):
                             rouge = rouge_l(s, r.split())
@@ -156,7 +149,7 @@ class Rollout(object):
 
                 if rouge_ratio:
                     rouge_scores = []
-                    summaries = outputsids2words(strip_pads(samples.tolist(), stop_token), dec_vocab)
+                    summaries = codec.ids2words(samples, stop_id=stop_token)
                     references = source_batch.original_abstracts
                     for s, r in zip(summaries, references):
                         rouge = rouge_l(s, r.split())
@@ -0,0 +1,90 @@
+from __future__ import unicode_literals, print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import io
+import os
+import random
+import sys
+from collections import namedtuple
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[START]", "[STOP]"]
+LETTERS = "abcdefgh"
+NUM_FILES = 4
+LINES_PER_FILE = 30
+
+# the hyperparameters the GenBatcher reads
+HParams = namedtuple("HParams", [
+    "max_enc_steps", "max_dec_steps", "batch_size", "beam_size", "data_path",
+    "use_shards", "batcher_workers", "batcher_memory_mb", "token_budget",
+    "bucket_boundaries", "dedup_scope", "shuffle_buffer", "rank", "world_size",
+    "data_seed", "use_length_index", "lcsts_source", "lcsts_enc_segment",
+    "lcsts_dec_segment", "lcsts_chunks"])
+
+
+def make_hps(data_path, **kwargs):
+    """The hyperparameters of a training GenBatcher reading data_path with
+    threads, the fields in kwargs overridden"""
+    defaults = dict(
+        max_enc_steps=25, max_dec_steps=5, batch_size=4, beam_size=1,
+        data_path=data_path, use_shards=False, batcher_workers=0,
+        batcher_memory_mb=0, token_budget=0, bucket_boundaries="",
+        dedup_scope="none", shuffle_buffer=0, rank=0, world_size=1,
+        data_seed=7, use_length_index=False, lcsts_source="",
+        lcsts_enc_segment=False, lcsts_dec_segment=True, lcsts_chunks=8)
+    defaults.update(kwargs)
+    return HParams(**defaults)
+
+
+def write_vocab(path, words):
+    with io.open(path, "w", encoding="utf-8") as f:
+        for w in SPECIAL_TOKENS + list(words):
+            f.write("%s 1 0\n" % w)
+
+
+def write_corpus(data_dir, seed=0):
+    """Writes the train.txt_* files, "article\\tabstract" lines of letters
+    with no two lines alike, some with a word out of the vocabularies"""
+    rng = random.Random(seed)
+    seen = set()
+    for file_index in range(NUM_FILES):
+        with io.open(os.path.join(data_dir, "train.txt_%s" % file_index), "w", encoding="utf-8") as f:
+            num_lines = 0
+            while num_lines < LINES_PER_FILE:
+                article = " ".join(rng.choice(LETTERS) for _ in range(rng.randint(3, 30)))
+                abstract = " ".join(rng.choice(LETTERS) for _ in range(rng.randint(1, 8)))
+                if (article, abstract) in seen:
+                    continue
+                seen.add((article, abstract))
+                if num_lines % 7 == 0:
+                    article += " zz"
+                f.write("%s\t%s\n" % (article, abstract))
+                num_lines += 1
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    """A small corpus with its vocabularies, returns (data_dir, enc_vocab,
+    dec_vocab)"""
+    data = pytest.importorskip("data")
+    data_dir = str(tmp_path)
+    write_vocab(os.path.join(data_dir, "enc_vocab"), LETTERS)
+    write_vocab(os.path.join(data_dir, "dec_vocab"), LETTERS)
+    write_corpus(data_dir)
+    return (data_dir,
+            data.Vocab(os.path.join(data_dir, "enc_vocab"), 0),
+            data.Vocab(os.path.join(data_dir, "dec_vocab"), 0))
+
+
+@pytest.fixture
+def no_threads(monkeypatch):
+    """The GenBatchers start no producer, the tests drive the generators"""
+    batcher = pytest.importorskip("batcher")
+    monkeypatch.setattr(batcher.GenBatcher, "_start_thread", lambda self, kind, index: None)
+    return batcher
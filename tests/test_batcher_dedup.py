@@ -0,0 +1,79 @@
+from __future__ import unicode_literals, print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import shutil
+
+import pytest
+
+from conftest import LINES_PER_FILE, NUM_FILES, make_hps
+
+
+def copy_shard(data_dir):
+    """Adds a copy of train.txt_1, read by other streams than the original"""
+    shutil.copy(os.path.join(data_dir, "train.txt_1"), os.path.join(data_dir, "train.txt_%s" % NUM_FILES))
+
+
+def read_epoch(batcher, reader, dedup_index):
+    """Reads the first epoch of a stream as fill_example_queue does, returns
+    the number of duplicates"""
+    stream = batcher.stream_name(reader)
+    num_duplicates = 0
+    for record in batcher.text_generator(reader):
+        if batcher._read_positions[stream].epoch > 0:
+            break
+        example = batcher.make_example(record)
+        if batcher.is_duplicate(example, record[2], dedup_index):
+            num_duplicates += 1
+    return num_duplicates
+
+
+@pytest.mark.parametrize("scope,expected", [("epoch", LINES_PER_FILE), ("global", LINES_PER_FILE), ("none", 0)])
+def test_duplicates_across_streams(corpus, no_threads, scope, expected):
+    data_dir, enc_vocab, dec_vocab = corpus
+    copy_shard(data_dir)
+    batcher = no_threads.GenBatcher(
+        "train", "train", enc_vocab, dec_vocab, make_hps(data_dir, dedup_scope=scope))
+    num_duplicates = 0
+    for reader in range(16):
+        # the streams get the index of the epoch from the batcher
+        num_duplicates += read_epoch(batcher, reader, batcher.epoch_dedup_index(0))
+    assert num_duplicates == expected
+
+
+def test_epoch_index_is_shared_and_dropped(corpus, no_threads):
+    data_dir, enc_vocab, dec_vocab = corpus
+    batcher = no_threads.GenBatcher(
+        "train", "train", enc_vocab, dec_vocab, make_hps(data_dir, dedup_scope="epoch"))
+    index = batcher.epoch_dedup_index(0)
+    assert batcher.epoch_dedup_index(0) is index
+    # the streams behind still read the previous epoch
+    assert batcher.epoch_dedup_index(1) is not index
+    assert batcher.epoch_dedup_index(0) is index
+    batcher.epoch_dedup_index(2)
+    assert batcher.epoch_dedup_index(0) is not index
+
+
+def test_a_record_read_again_is_not_a_duplicate(corpus, no_threads):
+    data_dir, enc_vocab, dec_vocab = corpus
+    copy_shard(data_dir)
+    for scope in ["epoch", "window"]:
+        batcher = no_threads.GenBatcher(
+            "train", "train", enc_vocab, dec_vocab, make_hps(data_dir, dedup_scope=scope))
+        records = {}
+        for name in ["train.txt_1", "train.txt_%s" % NUM_FILES]:
+            ref = no_threads.data.OriginalRef(os.path.join(data_dir, name), 0)
+            article, abstract = no_threads.data.read_original(ref)
+            records[name] = (article, abstract, ref)
+        dedup_index = {}
+        window_index = {}
+        results = []
+        for name in ["train.txt_1", "train.txt_1", "train.txt_%s" % NUM_FILES]:
+            example = batcher.make_example(records[name])
+            example.source_ref = records[name][2]
+            if scope == "epoch":
+                results.append(batcher.is_duplicate(example, example.source_ref, dedup_index))
+            else:
+                results.append(batcher.is_window_duplicate(example, window_index))
+        assert results == [False, False, True]
@@ -0,0 +1,106 @@
+from __future__ import unicode_literals, print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import itertools
+import json
+from collections import namedtuple
+
+import pytest
+
+from conftest import make_hps
+
+FakeProcess = namedtuple("FakeProcess", ["pid"])
+
+
+class FakeSlots(object):
+
+    def reclaim(self, owner):
+        pass
+
+
+def read_examples(batcher, reader, num):
+    """Reads num Examples of a stream stamped with their positions and
+    sources as fill_example_queue does"""
+    stream = batcher.stream_name(reader)
+    examples = []
+    for record in itertools.islice(batcher.text_generator(reader), num):
+        example = batcher.make_example(record)
+        example.position = (stream, batcher._read_positions[stream])
+        example.source_ref = record[2]
+        examples.append(example)
+    return examples
+
+
+def test_state_saves_the_furthest_consumed_record(corpus, no_threads):
+    data_dir, enc_vocab, dec_vocab = corpus
+    hps = make_hps(data_dir)
+    batcher = no_threads.GenBatcher("train", "train", enc_vocab, dec_vocab, hps)
+    examples = read_examples(batcher, 0, 10)
+    stream = batcher.stream_name(0)
+    # the bucketing reorders the examples and the batches
+    batcher.put_batch([examples[5], examples[7], examples[6]])
+    batcher.put_batch([examples[2], examples[0], examples[1]])
+    batcher.next_batch()
+    assert batcher.state()["positions"][stream] == examples[7].position[1]._asdict()
+    batcher.next_batch()
+    state = json.loads(json.dumps(batcher.state()))
+    assert state["positions"][stream] == examples[7].position[1]._asdict()
+
+    resumed = no_threads.GenBatcher("train", "train", enc_vocab, dec_vocab, hps, state=state)
+    # the records read ahead of the consumed ones are read again
+    record = next(resumed.text_generator(0))
+    assert record[2] == examples[8].source_ref
+
+
+@pytest.mark.parametrize("shuffle_buffer", [1, 5])
+def test_shuffled_stream_resumes_in_order(corpus, no_threads, shuffle_buffer):
+    data_dir, enc_vocab, dec_vocab = corpus
+    hps = make_hps(data_dir, shuffle_buffer=shuffle_buffer)
+
+    def run(state, num):
+        batcher = no_threads.GenBatcher("train", "train", enc_vocab, dec_vocab, hps, state=state)
+        stream = batcher.stream_name(1)
+        records = batcher.shuffled_generator(1, batcher.text_generator(1))
+        refs = []
+        positions = []
+        for record in itertools.islice(records, num):
+            refs.append(record[2])
+            positions.append(batcher._positions[stream])
+        return stream, refs, positions
+
+    # a stream reads a part of a file, 30 records cross the epochs
+    stream, refs, positions = run(None, 30)
+    assert len(set(refs[:8])) == 8
+    for k in range(1, 25):
+        state = {"positions": {stream: positions[k - 1]._asdict()}}
+        assert run(state, 30 - k)[1] == refs[k:]
+
+
+def test_restarted_worker_resumes_after_the_consumed_records(corpus, no_threads, monkeypatch):
+    data_dir, enc_vocab, dec_vocab = corpus
+    saved = no_threads.ReaderPosition(7, 0, 0, 120, 0)._asdict()
+    batcher = no_threads.GenBatcher(
+        "train", "train", enc_vocab, dec_vocab, make_hps(data_dir),
+        state={"positions": {"worker-0": saved, "worker-1": saved}})
+    started = []
+
+    def start_worker(worker_id):
+        # the new worker process takes its position from the restored ones
+        started.append(batcher.start_position("worker-%s" % worker_id))
+        return FakeProcess(len(started) + 100)
+
+    monkeypatch.setattr(batcher, "_start_worker", start_worker)
+    batcher._workers = [FakeProcess(1), FakeProcess(2)]
+    batcher._slots = FakeSlots()
+    # as after start_workers
+    batcher._restored_positions.clear()
+    consumed = no_threads.ReaderPosition(7, 1, 0, 60, 0)
+    batcher._consumed_positions["worker-0"] = consumed
+
+    batcher.handle_failure(no_threads.ProducerFailure("worker", 0, "killed", 1))
+    batcher.handle_failure(no_threads.ProducerFailure("worker", 1, "killed", 2))
+    # a stale report of the replaced worker is ignored
+    batcher.handle_failure(no_threads.ProducerFailure("worker", 0, "killed", 1))
+    assert started == [consumed, no_threads.ReaderPosition(**saved)]
+    assert not batcher._restored_positions
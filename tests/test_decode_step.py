@@ -0,0 +1,48 @@
+from __future__ import unicode_literals, print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+utils = pytest.importorskip("utils")
+
+
+def test_conv_decoder_stack_step_matches_the_full_stack():
+    rng = np.random.RandomState(0)
+    batch_size, dec_len, enc_len, emb_dim = 2, 6, 4, 6
+    # a layer changes the width to go through the residual mapping
+    nhids_list, kwidths_list = [8, 8, 10], [3, 2, 3]
+    dropout_dict = {'src': 1.0, 'hid': 1.0}
+    with tf.Graph().as_default():
+        target_embed = tf.constant(rng.randn(batch_size, dec_len, emb_dim), tf.float32)
+        inputs = tf.constant(rng.randn(batch_size, dec_len, nhids_list[0]), tf.float32)
+        attention_keys = tf.constant(rng.randn(batch_size, enc_len, emb_dim), tf.float32)
+        attention_values = tf.constant(rng.randn(batch_size, enc_len, emb_dim), tf.float32)
+        enc_padding_mask = tf.constant([[1, 1, 1, 1], [1, 1, 0, 0]], tf.float32)
+        with tf.variable_scope("decoder") as scope:
+            full = utils.conv_decoder_stack(
+                target_embed, attention_keys, attention_values, inputs, enc_padding_mask,
+                nhids_list, kwidths_list, dropout_dict, is_training=False)
+            scope.reuse_variables()
+            attention_key_projs = []
+            for layer_idx in range(len(nhids_list)):
+                with tf.variable_scope("attention_layer_" + str(layer_idx)):
+                    attention_key_projs.append(utils.attention_key_projection(attention_keys, emb_dim))
+            layer_states = [
+                tf.zeros([batch_size, kwidth - 1, nhids_list[max(layer_idx - 1, 0)]])
+                for layer_idx, kwidth in enumerate(kwidths_list)]
+            steps = []
+            for t in range(dec_len):
+                output, layer_states = utils.conv_decoder_stack_step(
+                    target_embed[:, t:t + 1], attention_key_projs, attention_values,
+                    inputs[:, t:t + 1], enc_padding_mask, nhids_list, kwidths_list,
+                    dropout_dict, layer_states)
+                steps.append(output)
+            stepped = tf.concat(steps, axis=1)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            full_outputs, step_outputs = sess.run([full, stepped])
+    assert step_outputs.shape == (batch_size, dec_len, nhids_list[-1])
+    np.testing.assert_allclose(step_outputs, full_outputs, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,79 @@
+from __future__ import unicode_literals, print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import glob
+import io
+import itertools
+import os
+
+import numpy as np
+import pytest
+
+from conftest import LETTERS, make_hps, write_vocab
+
+data = pytest.importorskip("data")
+
+
+def compile_all(data_dir, enc_vocab, dec_vocab):
+    for text_file in sorted(glob.glob(os.path.join(data_dir, "train.txt_*"))):
+        data.compile_shard(text_file, enc_vocab, dec_vocab)
+
+
+def test_token_shard_records_match_the_text_lines(corpus):
+    data_dir, enc_vocab, dec_vocab = corpus
+    compile_all(data_dir, enc_vocab, dec_vocab)
+    text_file = os.path.join(data_dir, "train.txt_1")
+    shard = data.TokenShard(text_file, enc_vocab, dec_vocab)
+    with io.open(text_file, "rb") as f:
+        lines = f.readlines()
+    assert len(shard) == len(lines)
+    offset = 0
+    for i, line in enumerate(lines):
+        article, abstract = line.decode("utf-8").strip().split("\t")
+        enc_ids, abs_ids, original_ref = shard.record(i)
+        assert enc_ids.tolist() == [enc_vocab.word2id(w) for w in article.split()]
+        assert abs_ids.tolist() == [dec_vocab.word2id(w) for w in abstract.split()]
+        assert original_ref == data.OriginalRef(text_file, offset)
+        assert data.read_original(original_ref) == (article, abstract)
+        offset += len(line)
+
+
+def test_shard_examples_match_text_examples(corpus, no_threads):
+    data_dir, enc_vocab, dec_vocab = corpus
+    compile_all(data_dir, enc_vocab, dec_vocab)
+    batcher = no_threads
+    # the truncation is applied to the untruncated shard ids
+    text_batcher = batcher.GenBatcher(
+        "train", "train", enc_vocab, dec_vocab, make_hps(data_dir, max_enc_steps=10, max_dec_steps=3))
+    shard_batcher = batcher.GenBatcher(
+        "train", "train", enc_vocab, dec_vocab,
+        make_hps(data_dir, max_enc_steps=10, max_dec_steps=3, use_shards=True))
+    num_records = 0
+    for reader in range(4):
+        text_records = itertools.islice(text_batcher.text_generator(reader), 10)
+        shard_records = itertools.islice(shard_batcher.shard_generator(reader), 10)
+        for text_record, shard_record in zip(text_records, shard_records):
+            text_example = text_batcher.make_example(text_record)
+            shard_example = shard_batcher.make_example(shard_record)
+            assert text_record[2] == shard_record[2]
+            for field in ["enc_input", "enc_len", "dec_input", "target", "dec_len"]:
+                assert np.array_equal(getattr(text_example, field), getattr(shard_example, field))
+            assert text_example.content_key == shard_example.content_key
+            assert shard_example.originals == text_example.originals
+            num_records += 1
+    assert num_records == 40
+
+
+def test_token_shard_rejects_other_vocabularies(corpus, tmp_path):
+    data_dir, enc_vocab, dec_vocab = corpus
+    compile_all(data_dir, enc_vocab, dec_vocab)
+    text_file = os.path.join(data_dir, "train.txt_0")
+    other_path = str(tmp_path / "other_vocab")
+    write_vocab(other_path, LETTERS + "z")
+    other_vocab = data.Vocab(other_path, 0)
+    with pytest.raises(ValueError):
+        data.TokenShard(text_file, enc_vocab, other_vocab)
+    # compiled again the shard is accepted
+    data.compile_shard(text_file, enc_vocab, other_vocab)
+    assert len(data.TokenShard(text_file, enc_vocab, other_vocab)) > 0
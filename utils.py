@@ -94,7 +94,8 @@ def initialize_uninitialized(sess):
 def print_dashboard(type, step, batch_size, enc_vocab_size, dec_vocab_size,
                     running_avg_loss, eval_loss,
                     total_training_time, current_speed, current_learning_rate,
-                    coverage_loss="not set"):
+                    coverage_loss="not set", data_wait_time=None, queue_stats=None,
+                    prefetched=False):
     print(
         "\nDashboard for %s updated %s, finished steps:\t%s\n"
         "\tBatch size:\t%s, current learning rate:\t%s\n"
@@ -119,6 +120,16 @@ def print_dashboard(type, step, batch_size, enc_vocab_size, dec_vocab_size,
             coverage_loss,
             )
     )
+    if data_wait_time is not None:
+        # the batches prefetched by the input pipeline are waited for by its
+        # producer thread, the waits of the training steps are not seen
+        print("\t%s:\t%.4f seconds/step\n" % (
+            "Input pipeline producer waiting for data" if prefetched else "Waiting for data",
+            data_wait_time))
+    if queue_stats:
+        for name, stats in sorted(queue_stats.items()):
+            print("\t%s:\t%s items, %.1f MB, %.0f%% full\n" % (
+                name, stats["items"], stats["bytes"] / 2 ** 20, stats["fill"] * 100))
 
 
 def pad_sample(best_samples, vocab, hps):
@@ -537,6 +548,54 @@ def conv_decoder_stack(target_embed, attention_keys, attention_values, inputs, e
     return next_layer
 
 
+def conv_decoder_stack_step(target_embed, attention_key_projs, attention_values, inputs, enc_padding_mask,
+                            nhids_list, kwidths_list, dropout_dict, layer_states):
+    """Runs conv_decoder_stack at inference for one new position given the
+    inputs of the last kwidth-1 positions of every layer, the causal conv of
+    a layer sees nothing else.
+
+    Args:
+      target_embed: the embedded new tokens, shape (batch_size, 1, emb_dim)
+      attention_key_projs: the projected attention keys of every layer, see
+        attention_key_projection
+      inputs: target_embed mapped to nhids_list[0]
+      layer_states: a list with the last kwidth-1 inputs of every layer,
+        shapes (batch_size, kwidth-1, nin), zeros before the first position
+
+    Returns:
+      next_layer: the output of the new position, shape (batch_size, 1, nout)
+      new_states: layer_states shifted by the inputs of the new position
+    """
+    next_layer = inputs
+    new_states = []
+
+    for layer_idx in range(len(nhids_list)):
+        nin = nhids_list[layer_idx] if layer_idx == 0 else nhids_list[layer_idx-1]
+        nout = nhids_list[layer_idx]
+        if nin != nout:
+            res_inputs = linear_mapping_weightnorm(next_layer, nout, dropout=dropout_dict['hid'], var_scope_name="linear_mapping_cnn_" + str(layer_idx))
+        else:
+            res_inputs = next_layer
+        # the window the padded conv of conv_decoder_stack sees at the new position
+        window = tf.concat([layer_states[layer_idx], next_layer], axis=1)
+        new_state = window[:, 1:, :]
+        # keep the static shape for the states carried through while loops
+        new_state.set_shape(layer_states[layer_idx].get_shape())
+        new_states.append(new_state)
+
+        next_layer = conv1d_weightnorm(inputs=window, layer_idx=layer_idx, out_dim=nout*2, kernel_size=kwidths_list[layer_idx], padding="VALID", dropout=dropout_dict['hid'], var_scope_name="conv_layer_"+str(layer_idx))
+        next_layer = gated_linear_units(next_layer)
+
+        att_out = make_attention(
+            target_embed, None, attention_values, next_layer, layer_idx, enc_padding_mask, False,
+            attention_key_proj=attention_key_projs[layer_idx])
+        next_layer = (next_layer + att_out) * tf.sqrt(0.5)
+
+        next_layer = (next_layer + res_inputs) * tf.sqrt(0.5)
+
+    return next_layer, new_states
+
+
 def linear_mapping_stupid(inputs, out_dim, in_dim=None, dropout=1.0, var_scope_name="linear_mapping"):
   with tf.variable_scope(var_scope_name):
     # print('name', tf.get_variable_scope().name)
@@ -556,8 +615,16 @@ def linear_mapping_stupid(inputs, out_dim, in_dim=None, dropout=1.0, var_scope_n
   return output
 
 
-def make_attention(target_embed, attention_keys, attention_values, decoder_hidden, layer_idx, enc_padding_mask, is_training):
+def attention_key_projection(attention_keys, embed_size):
+    """The attention keys projected as make_attention does in the variable
+    scope of its layer, it depends on the encoder only"""
+    return linear_mapping_weightnorm(attention_keys, embed_size, var_scope_name="linear_mapping_enc_output")
+
+
+def make_attention(target_embed, attention_keys, attention_values, decoder_hidden, layer_idx, enc_padding_mask, is_training,
+                   attention_key_proj=None):
     # this is the so called dot product attention
+    # attention_key_proj: the attention_key_projection of the keys if already computed
     # TODO: the tf.sqrt(0.5) should be replaced to make the attention scaled dot product attention
     # enc_padding_mask: M*N2
     def enc_mask(att_score):
@@ -586,7 +653,8 @@ def make_attention(target_embed, attention_keys, attention_values, decoder_hidde
         dec_hidden_proj = linear_mapping_weightnorm(decoder_hidden, embed_size, var_scope_name="linear_mapping_att_query")
         # M*N1*k1 --> M*N1*k
         dec_rep = (dec_hidden_proj + target_embed) * tf.sqrt(0.5)
-        attention_key_proj = linear_mapping_weightnorm(attention_keys, embed_size, var_scope_name="linear_mapping_enc_output")
+        if attention_key_proj is None:
+            attention_key_proj = attention_key_projection(attention_keys, embed_size)
 
         att_score = tf.matmul(dec_rep, attention_key_proj, transpose_b=True)
         # M*N1*K  ** M*N2*K  --> M*N1*N2